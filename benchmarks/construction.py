@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the fixed costs of small streams: creating a stream,
+adding stages to it, and running a terminal operation on a few elements.
+
+Run with ``python benchmarks/construction.py``; the results are in
+nanoseconds per operation.
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import timeit
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+SETUP = 'from streams import Stream; data = list(range(%d)); ' \
+        'pred = lambda x: x & 1; f = lambda x: x + 1'
+
+CASES = [
+    ('create', 'Stream(data)'),
+    ('create + to_list', 'Stream(data).to_list()'),
+    ('of + filter + to_list', 'Stream.of(1, 2, 3).filter(pred).to_list()'),
+    ('1 stage', 'Stream(data).filter(pred).to_list()'),
+    ('2 stages', 'Stream(data).filter(pred).map(f).to_list()'),
+    ('distinct', 'Stream(data).distinct().to_list()'),
+    ('4 stages', 'Stream(data).filter(pred).map(f).filter(pred).map(f)'
+                 '.to_list()'),
+]
+
+
+def bench(statement, size, number=100000):
+    timer = timeit.Timer(statement, SETUP % size)
+    best = min(timer.repeat(5, number))
+    return best / number * 1e9
+
+
+def import_time():
+    statement = 'import time; t = time.time(); import streams; ' \
+                'print(time.time() - t)'
+    command = [sys.executable, '-c', statement]
+    times = [
+        float(subprocess.check_output(command, cwd=ROOT))
+        for _ in range(5)
+    ]
+    return min(times) * 1e3
+
+
+def main():
+    print('import streams: %.2f ms' % import_time())
+    for size in (3, 100):
+        print('\n%d elements:' % size)
+        for name, statement in CASES:
+            print('  %-24s %8.0f ns' % (name, bench(statement, size)))
+
+    empty = bench('Stream(data).to_list()', 0)
+    full = bench('Stream(data).to_list()', 100)
+    print('\nper element (to_list): %.1f ns' % ((full - empty) / 100))
+    one = bench('Stream(data).filter(pred).to_list()', 0)
+    four = bench('Stream(data).filter(pred).map(f).filter(pred).map(f)'
+                 '.to_list()', 0)
+    print('per stage (empty source): %.0f ns' % ((four - one) / 3))
+
+
+if __name__ == '__main__':
+    main()
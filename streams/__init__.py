@@ -1,28 +1,482 @@
 from __future__ import division
+from collections import deque
+from heapq import merge, nlargest
 from itertools import islice, chain, starmap, tee
+import sys
 
-try:
-    from future_builtins import filter, map
-except:
-    if isinstance(filter(True, []), list):
-        from itertools import ifilter as filter, imap as map
+# The submodules used by the heavier operators (threads, processes,
+# temporary files, hashing) are imported by the operators themselves,
+# so that importing streams stays cheap.
+
+if sys.version_info[0] < 3:
+    from itertools import ifilter as filter, imap as map
+    _range_type = xrange
+else:
+    _range_type = range
+
+_getrefcount = getattr(sys, 'getrefcount', None)
 
 EMPTY = object()
 
+#: Characteristic flags of a stream, see :attr:`Stream.characteristics`.
+#: The encounter order of the elements is meaningful.
+ORDERED = 0x1
+#: No two elements are equal.
+DISTINCT = 0x2
+#: The elements are in ascending natural order.
+SORTED = 0x4
+#: ``len()`` of the underlying iterable gives the number of elements.
+SIZED = 0x8
+
+#: Flags kept by operators that drop elements but do not change them.
+_SUBSET = ORDERED | DISTINCT | SORTED
+
+#: Sized sources up to this length are processed eagerly by operators
+#: that call no user code, such as ``distinct``.
+_SMALL_SOURCE = 64
+
+#: The smallest number of elements that the Bloom filter of a budgeted
+#: ``distinct`` is sized for.
+_MIN_BLOOM_CAPACITY = 1 << 16
+
+_ITEM, _ERROR, _DONE = range(3)
+_POLL_INTERVAL = 0.05
+
+
+_type_characteristics = {}
+
+#: Source types whose ``len()`` is cheap and cannot fail; the length of
+#: other sized sources, such as huge ranges or lazy database queries, is
+#: not asked for when the stream is created.
+_CONTAINER_TYPES = frozenset([
+    list, tuple, set, frozenset, dict, str, bytes, bytearray
+])
+
+
+def _source_characteristics(iterable):
+    """
+    Return the characteristic flags that can be inferred from the type
+    of a stream source.
+    """
+    cls = type(iterable)
+    flags = _type_characteristics.get(cls)
+    if flags is None:
+        if issubclass(cls, (set, frozenset, dict)):
+            flags = DISTINCT
+        else:
+            flags = ORDERED
+
+        if hasattr(cls, '__len__'):
+            flags |= SIZED
+
+        _type_characteristics[cls] = flags
+
+    if cls in _CONTAINER_TYPES:
+        if not len(iterable):
+            return flags | DISTINCT | SORTED
+
+    elif cls is _range_type:
+        # truth testing, unlike len(), works for ranges of any length
+        if not iterable or getattr(iterable, 'step', 1) > 0:
+            flags |= DISTINCT | SORTED
+
+    return flags
+
+
+def _put_until(queue, entry, stop):
+    """
+    Put ``entry`` into the bounded ``queue``, giving up if ``stop``
+    becomes set while waiting for room. Returns True if the entry
+    was queued.
+    """
+    try:
+        from queue import Full
+    except ImportError:
+        from Queue import Full
+
+    while not stop.is_set():
+        try:
+            queue.put(entry, timeout=_POLL_INTERVAL)
+            return True
+
+        except Full:
+            pass
+
+    return False
+
+
+def _drain(queue):
+    """
+    Discard everything currently in ``queue``, waking up any producer
+    blocked on putting into it.
+    """
+    try:
+        from queue import Empty
+    except ImportError:
+        from Queue import Empty
+
+    try:
+        while True:
+            queue.get_nowait()
+
+    except Empty:
+        pass
+
+
+def _prefetch(iterable, n):
+    """
+    Iterate over ``iterable`` on a background thread, keeping up to ``n``
+    elements buffered ahead of the consumer. Exceptions raised by the
+    iterable are re-raised in the consumer; when the consumer stops
+    early, the background thread stops at the next element.
+    """
+    from threading import Event, Thread
+    try:
+        from queue import Queue
+    except ImportError:
+        from Queue import Queue
+
+    queue = Queue(n)
+    stop = Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                if not _put_until(queue, (_ITEM, item), stop):
+                    return
+
+            _put_until(queue, (_DONE, None), stop)
+
+        except BaseException as e:
+            _put_until(queue, (_ERROR, e), stop)
+
+    thread = Thread(target=producer, name='streams-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            kind, value = queue.get()
+            if kind == _ITEM:
+                yield value
+
+            elif kind == _ERROR:
+                raise value
+
+            else:
+                return
+
+    finally:
+        stop.set()
+        _drain(queue)
+
+
+def _map_concurrent(func, iterable, workers, ordered, max_in_flight):
+    """
+    Map ``func`` over ``iterable`` on a pool of ``workers`` threads with at
+    most ``max_in_flight`` calls submitted but not yet consumed. Pending
+    calls are cancelled when the consumer stops early.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    executor = ThreadPoolExecutor(workers)
+    it = iter(iterable)
+    pending = deque() if ordered else set()
+    add = pending.append if ordered else pending.add
+
+    def submit(n):
+        for item in islice(it, n):
+            add(executor.submit(func, item))
+
+    try:
+        submit(max_in_flight)
+        if ordered:
+            while pending:
+                result = pending.popleft().result()
+                submit(1)
+                yield result
+
+        else:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                add = pending.add
+                submit(len(done))
+                for future in done:
+                    yield future.result()
+
+    finally:
+        for future in pending:
+            future.cancel()
+
+        executor.shutdown(wait=False)
+
+
+class _SpillingTee(object):
+    """
+    One of the two iterators returned by ``_spilling_tee``. When it is
+    closed or garbage collected, its queue is released and the other
+    iterator stops buffering elements for it.
+    """
+
+    def __init__(self, it, mine, other):
+        self._it = it
+        self._mine = mine
+        self._other = other
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._mine:
+            return self._mine.popleft()
+
+        e = next(self._it)
+        if not self._other.closed:
+            self._other.append(e)
+
+        return e
+
+    next = __next__
+
+    def close(self):
+        self._mine.close()
+
+    __del__ = close
+
+
+def _spilling_tee(iterable, account):
+    """
+    Like ``itertools.tee(iterable)``, but the elements buffered for the
+    lagging iterator are kept in a :class:`~streams.memory.SpillQueue`.
+    """
+    from .memory import SpillQueue
+    it = iter(iterable)
+    queues = SpillQueue(account), SpillQueue(account)
+    return (
+        _SpillingTee(it, queues[0], queues[1]),
+        _SpillingTee(it, queues[1], queues[0])
+    )
+
+
+class _Pipeline(object):
+    """
+    Settings shared by the stages of a stream pipeline; created by
+    the first operation that needs it.
+    """
+
+    __slots__ = ('executor', 'budget', 'checkpointing', 'distributed')
+
+    def __init__(self):
+        self.executor = None
+        self.budget = None
+        self.checkpointing = None
+        self.distributed = None
+
+    def derive(self, distributed):
+        """
+        Return a copy of these settings with the distributed plan
+        ``distributed``.
+        """
+        pipeline = _Pipeline()
+        pipeline.executor = self.executor
+        pipeline.budget = self.budget
+        pipeline.checkpointing = self.checkpointing
+        pipeline.distributed = distributed
+        return pipeline
+
+
 class Stream(object):
     """
     Create a new stream instance from ``iterables``.
+
+    The stateful operators of the pipeline (``distinct``, ``sorted`` and
+    ``partition``) buffer at most about ``memory_budget`` bytes, given
+    as a number or as a :class:`~streams.memory.MemoryBudget` that can be
+    shared by several pipelines; see :mod:`streams.memory`.
     """
 
-    def __init__(self, *iterables):
+    __slots__ = ('_iterable', '_characteristics', '_pipeline')
+
+    def __init__(self, *iterables, **kwargs):
+        self._pipeline = None
+        if kwargs:
+            self._init_options(**kwargs)
+
         if len(iterables) == 1:
             self._iterable = iterables[0]
+            self._characteristics = _source_characteristics(self._iterable)
         else:
             self._iterable = chain.from_iterable(iterables)
+            self._characteristics = ORDERED
+
+    def _init_options(self, memory_budget=None):
+        if memory_budget is not None:
+            from .memory import MemoryBudget
+            if not isinstance(memory_budget, MemoryBudget):
+                memory_budget = MemoryBudget(memory_budget)
+
+            self._pipeline = _Pipeline()
+            self._pipeline.budget = memory_budget
 
     @classmethod
-    def _make_stream(cls, iterable):
-        return cls(iterable)
+    def _make_stream(cls, iterable, characteristics=None):
+        if characteristics is None or cls.__init__ is not _stream_init:
+            stream = cls(iterable)
+            if characteristics is not None:
+                stream._characteristics = characteristics
+
+            return stream
+
+        stream = cls.__new__(cls)
+        stream._iterable = iterable
+        stream._characteristics = characteristics
+        stream._pipeline = None
+        return stream
+
+    def _chain(self, iterable, characteristics, fresh=False, stage=None):
+        """
+        Return the stream for the next stage of this pipeline. If nothing
+        but the caller refers to this stream, it is updated in place and
+        reused instead of allocating a new one, unless ``fresh`` is true.
+
+        ``stage`` is the stateless ``(method, func)`` stage that the
+        workers of a distributed pipeline can run; any other stage makes
+        the pipeline run locally.
+        """
+        pipeline = self._pipeline
+        if pipeline is not None and pipeline.distributed is not None:
+            # several streams may be derived from one distributed stream,
+            # so each of them keeps its own list of stages
+            pipeline = pipeline.derive(pipeline.distributed.then(stage))
+
+        if (not fresh and _UNSHARED_REFCOUNT >= 0 and type(self) is Stream
+                and _getrefcount(self) <= _UNSHARED_REFCOUNT):
+            self._iterable = iterable
+            self._characteristics = characteristics
+            self._pipeline = pipeline
+            return self
+
+        stream = self._make_stream(iterable, characteristics)
+        stream._pipeline = pipeline
+        return stream
+
+    def _executor_for(self, func):
+        """
+        Return the parallel executor to run ``func`` with, or None if the
+        stage should run sequentially.
+        """
+        if self._pipeline is None or self._pipeline.executor is None:
+            return None
+
+        executor = self._pipeline.executor
+        if not executor.can_run(func):
+            return None
+
+        self._not_checkpointable('a parallel stage')
+
+        return executor
+
+    def _distributed(self, terminal, *args):
+        """
+        Run the terminal operation ``terminal(*args)`` on the partitions of
+        a distributed pipeline, returning the list of partition results,
+        or None if the pipeline has to run locally.
+        """
+        if self._pipeline is None or self._pipeline.distributed is None:
+            return None
+
+        plan = self._pipeline.distributed
+        if not plan.can_run(args):
+            return None
+
+        return plan.run(terminal, args)
+
+    def _account(self, name):
+        """
+        Return a memory account for the operator ``name``, or None if the
+        pipeline has no memory budget.
+        """
+        if self._pipeline is None or self._pipeline.budget is None:
+            return None
+
+        return self._pipeline.budget.account(name)
+
+    def _checkpoint_state(self, factory):
+        """
+        Return the checkpointed state of a stateful operator, or None if
+        the pipeline is not checkpointed.
+        """
+        if self._pipeline is None or self._pipeline.checkpointing is None:
+            return None
+
+        return self._pipeline.checkpointing.register(factory)
+
+    def _terminal_state(self, initial):
+        """
+        Return the checkpointed accumulator for a terminal operation, or
+        None if the pipeline is not checkpointed.
+        """
+        if self._pipeline is None or self._pipeline.checkpointing is None:
+            return None
+
+        return self._pipeline.checkpointing.register_terminal(initial)
+
+    def _no_saved_result(self, name):
+        """
+        Reject the terminal operation ``name`` on a checkpointed pipeline;
+        checkpoints do not save its partial result, so after a resume it
+        would only see the elements after the checkpoint.
+        """
+        if self._pipeline is None or self._pipeline.checkpointing is None:
+            return
+
+        raise ValueError(
+            "%s cannot be the terminal operation of a checkpointed stream"
+            % name
+        )
+
+    def _not_checkpointable(self, name):
+        """
+        Record that the operator ``name`` keeps state that checkpoints do
+        not save; it is an error after a checkpoint stage.
+        """
+        if self._pipeline is None or self._pipeline.checkpointing is None:
+            return
+
+        checkpointing = self._pipeline.checkpointing
+        if checkpointing.stage:
+            raise ValueError(
+                "%s cannot be used in a checkpointed stream" % name
+            )
+
+        checkpointing.blocker = checkpointing.blocker or name
+
+    @property
+    def memory_budget(self):
+        """
+        The :class:`~streams.memory.MemoryBudget` of this pipeline, or None.
+        Its ``report()`` gives the peak memory held by each operator.
+        """
+        if self._pipeline is None:
+            return None
+
+        return self._pipeline.budget
+
+    @property
+    def characteristics(self):
+        """
+        The characteristic flags of this stream, a combination of
+        ``ORDERED``, ``DISTINCT``, ``SORTED`` and ``SIZED``. Sources set
+        the flags that follow from their type, and each operator keeps,
+        clears or sets them, so that redundant work can be skipped, for
+        example sorting a stream that is already sorted.
+        """
+        return self._characteristics
+
+    def has_characteristics(self, flags):
+        """
+        Returns True if this stream has all of the given characteristic
+        ``flags``.
+        """
+        return self._characteristics & flags == flags
 
     def all_match(self, predicate):
         """
@@ -31,6 +485,7 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        self._no_saved_result('all_match')
         return all(predicate(i) for i in self._iterable)
 
     def any_match(self, predicate):
@@ -40,6 +495,7 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        self._no_saved_result('any_match')
         return any(predicate(i) for i in self._iterable)
 
     def none_match(self, predicate):
@@ -49,6 +505,7 @@ class Stream(object):
 
         This is a terminal operator.
         """
+        self._no_saved_result('none_match')
         return not any(predicate(i) for i in self._iterable)
 
     def apply_to(self, func):
@@ -61,14 +518,37 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        self._no_saved_result('apply_to')
         return func(self._iterable)
 
+    def approx_count_distinct(self, precision=14):
+        """
+        Returns an estimate of the number of distinct elements in this
+        stream, computed with a HyperLogLog sketch of ``2 ** precision``
+        registers; unlike ``distinct().count()`` the memory use does
+        not grow with the number of distinct elements.
+
+        This is a terminal operation.
+        """
+        self._no_saved_result('approx_count_distinct')
+        from .sketches import HyperLogLog
+        return HyperLogLog(precision).update_all(self._iterable).estimate()
+
     def average(self):
         """
         Returns the numeric average of this stream.
 
         This is a terminal operation.
         """
+        state = self._terminal_state((0, 0))
+        if state is not None:
+            for i in self._iterable:
+                the_sum, number = state.value
+                state.value = the_sum + i, number + 1
+
+            the_sum, number = state.value
+            return the_sum / number
+
         the_sum = 0
         number = 0
         for i in self._iterable:
@@ -77,8 +557,77 @@ class Stream(object):
 
         return the_sum / number
 
+    def checkpoint(self, every, store=None):
+        """
+        Returns a stream that saves a checkpoint after every ``every``
+        elements that pass through it, to the store given to
+        :meth:`resume` or to ``store``. See :mod:`streams.checkpoint`.
+        """
+        if self._pipeline is None or self._pipeline.checkpointing is None:
+            raise ValueError("checkpoint needs a stream created by resume()")
+
+        checkpointing = self._pipeline.checkpointing
+        if checkpointing.blocker:
+            raise ValueError(
+                "%s cannot be used in a checkpointed stream"
+                % checkpointing.blocker
+            )
+
+        if checkpointing.stage:
+            raise ValueError("a stream can have only one checkpoint stage")
+
+        if every < 1:
+            raise ValueError("checkpoint interval must be positive")
+
+        checkpointing.stage = True
+        if store is not None:
+            from .checkpoint import CheckpointStore
+            checkpointing.store = CheckpointStore(store)
+
+        def gen(iterable):
+            passed = checkpointing.passed()
+            for e in iterable:
+                yield e
+                passed += 1
+                if not passed % every:
+                    checkpointing.save(passed)
+
+            checkpointing.complete()
+
+        return self._chain(
+            gen(self._iterable),
+            self._characteristics & _SUBSET
+        )
+
     def collect(self, supplier, accumulator, combiner):
-        raise NotImplementedError
+        """
+        Performs a mutable reduction: creates a container with
+        ``supplier()`` and calls ``accumulator(container, e)`` for each
+        element; returns the container::
+
+            >>> Stream(range(3)).collect(list, list.append, list.extend)
+            [0, 1, 2]
+
+        A distributed stream collects each partition into a container
+        of its own, and ``combiner(first, second)`` folds the container
+        ``second`` into ``first``.
+
+        This is a terminal operation.
+        """
+        self._no_saved_result('collect')
+        partials = self._distributed('collect', supplier, accumulator, None)
+        if partials is not None:
+            container = partials[0]
+            for partial in partials[1:]:
+                combiner(container, partial)
+
+            return container
+
+        container = supplier()
+        for i in self._iterable:
+            accumulator(container, i)
+
+        return container
 
     def count(self):
         """
@@ -86,31 +635,168 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        if self._characteristics & SIZED:
+            try:
+                return len(self._iterable)
+
+            except OverflowError:
+                # longer than sys.maxsize, such as a huge range
+                pass
+
+        partials = self._distributed('count')
+        if partials is not None:
+            return sum(partials)
+
+        state = self._terminal_state(0)
+        if state is not None:
+            for i in self._iterable:
+                state.value += 1
+
+            return state.value
+
         return sum(1 for i in self._iterable)
 
+    def distributed(self, cluster, partitions=None):
+        """
+        Return a distributed version of this stream, whose source, a sized
+        sequence or a file returned by :func:`open`, is split into
+        ``partitions`` partitions run on the workers of ``cluster``; see
+        :mod:`streams.distributed`.
+
+        The ``map``, ``filter`` and ``starmap`` stages after this call run
+        on the workers, and so do the terminal operations ``count``,
+        ``sum``, ``collect``, ``top_k``, ``group_by`` and ``to_list``,
+        whose partition results are then combined in partition order. If
+        the pipeline has other stages or functions that cannot be pickled,
+        it runs locally instead.
+        """
+        from .distributed import DistributedPlan
+        plan = DistributedPlan(cluster, self._iterable, partitions)
+        if self._pipeline is None:
+            self._pipeline = _Pipeline()
+            self._pipeline.distributed = plan
+
+        else:
+            self._pipeline = self._pipeline.derive(plan)
+
+        return self
+
     def distinct(self):
         """
         Return a stream with distinct elements from this stream.
         The elements must be hashable.
+
+        A stream that is already distinct is returned as is, and a sorted
+        stream is deduplicated by comparing neighbouring elements instead
+        of remembering all the elements seen. When the memory budget runs
+        out, the elements seen are moved into a Bloom filter, after which
+        a small fraction of distinct elements may be dropped.
         """
-        def gen():
+        if self._characteristics & DISTINCT:
+            return self
+
+        flags = self._characteristics & _SUBSET | DISTINCT
+        if (self._pipeline is None
+                and type(self._iterable) in (list, tuple)
+                and len(self._iterable) <= _SMALL_SOURCE):
+            # a small list needs no generator; no user code runs early
             seen = set()
-            for e in self._iterable:
+            result = [
+                e for e in self._iterable
+                if not (e in seen or seen.add(e))
+            ]
+            return self._chain(result, flags | SIZED)
+
+        # the generators take the upstream iterable as an argument, as
+        # _chain may reuse this stream for the next stage
+
+        def gen(iterable, seen):
+            for e in iterable:
                 if e not in seen:
                     seen.add(e)
                     yield e
 
-        return self._make_stream(gen())
+        def gen_budgeted(iterable, account):
+            from .memory import BloomFilter, element_size
+            seen = set()
+            bloom = None
+            try:
+                for e in iterable:
+                    if bloom is not None:
+                        if not bloom.add(e):
+                            yield e
+
+                    elif e not in seen:
+                        seen.add(e)
+                        if not account.reserve(element_size(e)):
+                            # room for many more elements than seen so
+                            # far, even if the budget was used up by
+                            # other operators
+                            bloom = BloomFilter.for_capacity(
+                                max(4 * len(seen), _MIN_BLOOM_CAPACITY)
+                            )
+                            for old in seen:
+                                bloom.add(old)
+
+                            seen = None
+                            account.release()
+                            account.reserve(len(bloom.bits))
+
+                        yield e
+
+            finally:
+                account.release()
+
+        def gen_sorted(iterable):
+            previous = EMPTY
+            for e in iterable:
+                if previous is EMPTY or e != previous:
+                    previous = e
+                    yield e
+
+        if self._characteristics & SORTED:
+            return self._chain(gen_sorted(self._iterable), flags)
+
+        account = self._account('distinct')
+        if account is not None:
+            self._not_checkpointable('distinct with a memory budget')
+            return self._chain(gen_budgeted(self._iterable, account), flags)
+
+        state = self._checkpoint_state(set)
+        seen = set() if state is None else state.value
+        return self._chain(gen(self._iterable, seen), flags)
 
     def enumerate(self, start=0):
-        return self._make_stream(enumerate(self._iterable, start))
+        self._not_checkpointable('enumerate')
+        # (index, element) pairs are ordered and unique by their index
+        flags = self._characteristics & ORDERED
+        if flags:
+            flags |= DISTINCT | SORTED
+
+        return self._chain(enumerate(self._iterable, start), flags)
 
     @classmethod
     def empty(cls):
         return cls([])
 
     def filter(self, predicate):
-        return self._make_stream(filter(predicate, self._iterable))
+        executor = stage = None
+        if self._pipeline is not None:
+            stage = 'filter', predicate
+            executor = self._executor_for(predicate)
+
+        if executor is not None:
+            iterable = executor.run(
+                predicate, self._iterable, filtering=True,
+                ordered=bool(self._characteristics & ORDERED)
+            )
+
+        else:
+            iterable = filter(predicate, self._iterable)
+
+        return self._chain(
+            iterable, self._characteristics & _SUBSET, stage=stage
+        )
 
     def find_any(self):
         return next(self._iterable, EMPTY)
@@ -128,21 +814,96 @@ class Stream(object):
         for i in self._iterable:
             action(i)
 
+    @classmethod
+    def from_compressed(cls, paths, codec='auto', threads=None,
+                        block_size=1 << 20, encoding=None):
+        """
+        Returns a new stream of the lines of the file or files at
+        ``paths``, like iterating over ``gzip.open(path)``, but read and
+        decompressed in blocks of ``block_size`` bytes on background
+        threads; see :mod:`streams.compressed`. Lines are bytes, or text
+        decoded with ``encoding`` if it is given.
+
+        The ``codec`` is one of ``'gz'``, ``'bz2'``, ``'xz'`` or None for
+        uncompressed files, or ``'auto'`` to detect it from the contents
+        of each file. Up to ``threads`` files (by default one per CPU)
+        are read concurrently and their lines are interleaved, keeping
+        the lines of each file in order; the resulting stream is ordered
+        only if there is one file.
+        """
+        from .compressed import CODECS, read_lines
+        if isinstance(paths, (str, bytes)) or hasattr(paths, '__fspath__'):
+            # a single path, possibly an os.PathLike such as pathlib.Path
+            paths = [paths]
+
+        else:
+            paths = list(paths)
+
+        if codec != 'auto' and codec not in CODECS:
+            raise ValueError("unknown codec %r" % (codec,))
+
+        if threads is None:
+            from multiprocessing import cpu_count
+            threads = cpu_count()
+
+        if threads < 1 or block_size < 1:
+            raise ValueError("threads and block_size must be positive")
+
+        threads = max(1, min(threads, len(paths)))
+        return cls._make_stream(
+            read_lines(paths, codec, threads, block_size, encoding),
+            ORDERED if len(paths) == 1 else 0
+        )
+
     @classmethod
     def generate(cls, supplier):
         def gen():
             while 1:
-                yield supplier()
+                try:
+                    e = supplier()
+
+                except StopIteration:
+                    # the supplier ends the stream
+                    return
+
+                yield e
+
+        return cls._make_stream(gen(), ORDERED)
+
+    def group_by(self, key):
+        """
+        Returns a dictionary that maps each ``key(e)`` to the list of the
+        elements ``e`` with that key, in encounter order::
+
+            >>> Stream(range(5)).group_by(lambda x: x % 2)
+            {0: [0, 2, 4], 1: [1, 3]}
+
+        This is a terminal operation.
+        """
+        self._no_saved_result('group_by')
+        partials = self._distributed('group_by', key)
+        if partials is not None:
+            groups = {}
+            for partial in partials:
+                for k, elements in partial.items():
+                    groups.setdefault(k, []).extend(elements)
+
+            return groups
+
+        groups = {}
+        for i in self._iterable:
+            groups.setdefault(key(i), []).append(i)
 
-        return cls._make_stream(gen())
+        return groups
 
     def __getitem__(self, item):
         """
         Returns a slice of this stream, as a stream.
         """
         if isinstance(item, slice):
+            self._not_checkpointable('slicing')
             rv_gen = islice(self._iterable, item.start, item.stop, item.step)
-            return self._make_stream(rv_gen)
+            return self._chain(rv_gen, self._characteristics & _SUBSET)
 
         else:
             raise IndexError("Streams only support slicing, not element indexing")
@@ -157,7 +918,11 @@ class Stream(object):
         """
         Returns a stream that will contain up to n elements of this stream.
         """
-        return self._make_stream(islice(self._iterable, n))
+        self._not_checkpointable('limit')
+        return self._chain(
+            islice(self._iterable, n),
+            self._characteristics & _SUBSET
+        )
 
     # PY2 compat
     def next(self):
@@ -177,7 +942,51 @@ class Stream(object):
         Returns a new stream that consists of the elements of
         this stream mapped through the given mapping function.
         """
-        return self._make_stream(map(mapper, self._iterable, *others))
+        executor = stage = None
+        if self._pipeline is not None and not others:
+            stage = 'map', mapper
+            executor = self._executor_for(mapper)
+
+        if executor is not None:
+            iterable = executor.run(
+                mapper, self._iterable,
+                ordered=bool(self._characteristics & ORDERED)
+            )
+
+        else:
+            iterable = map(mapper, self._iterable, *others)
+
+        return self._chain(
+            iterable, self._characteristics & ORDERED, stage=stage
+        )
+
+    def map_concurrent(self, mapper, workers=8, ordered=True,
+                       max_in_flight=None):
+        """
+        Returns a new stream of the elements of this stream mapped through
+        ``mapper`` on a pool of ``workers`` threads; meant for mappers that
+        block on I/O.
+
+        At most ``max_in_flight`` (by default ``2 * workers``) elements are
+        taken from this stream ahead of the consumer. If ``ordered`` is
+        false, results are yielded as soon as they complete instead of in
+        the order of the elements. When the returned stream is closed
+        early, mapper calls that have not started are cancelled.
+        """
+        self._not_checkpointable('map_concurrent')
+
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+
+        if workers < 1 or max_in_flight < 1:
+            raise ValueError("workers and max_in_flight must be positive")
+
+        return self._chain(
+            _map_concurrent(
+                mapper, self._iterable, workers, ordered, max_in_flight
+            ),
+            self._characteristics & ORDERED if ordered else 0
+        )
 
     def max(self, key=None):
         """
@@ -186,7 +995,18 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        self._no_saved_result('max')
         if key == None:
+            # without DISTINCT the last element may be one of several
+            # equal maximal elements, and the builtin returns the first
+            if self._characteristics & (SORTED | DISTINCT) \
+                    == SORTED | DISTINCT:
+                last = deque(self._iterable, maxlen=1)
+                if not last:
+                    raise ValueError("max() arg is an empty sequence")
+
+                return last[0]
+
             return max(self._iterable)
 
         return max(self._iterable, key=key)
@@ -198,7 +1018,14 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        self._no_saved_result('min')
         if key == None:
+            if self._characteristics & SORTED:
+                for i in self._iterable:
+                    return i
+
+                raise ValueError("min() arg is an empty sequence")
+
             return min(self._iterable)
 
         return min(self._iterable, key=key)
@@ -217,12 +1044,38 @@ class Stream(object):
         """
         return self._make_stream(values)
 
-    def parallel(self):
+    @classmethod
+    def merge_sorted(cls, *iterables):
+        """
+        Returns a new sorted stream that lazily merges the given
+        iterables, each of which must be sorted in ascending order::
+
+            >>> Stream.merge_sorted([1, 4, 7], [2, 5], [3, 6]).to_list()
+            [1, 2, 3, 4, 5, 6, 7]
+
+        """
+        return cls._make_stream(merge(*iterables), ORDERED | SORTED)
+
+    def parallel(self, workers=None, executor=None):
         """
         Return a possibly parallelized version of this stream.
-        A parallel stream is unordered; the order of elements is
-        not specified at the terminal operation.
+
+        The ``map`` and ``filter`` operations after this call run on a
+        :class:`~streams.parallel.ParallelExecutor` with ``workers``
+        processes, or on the given ``executor``, whose ``stats()`` shows
+        the chunk sizes chosen. Functions that cannot be pickled, such
+        as lambdas, are run sequentially. Results keep their order
+        unless the ``ORDERED`` characteristic has been cleared, for
+        example with :meth:`unordered`.
         """
+        if self._pipeline is None:
+            self._pipeline = _Pipeline()
+
+        if executor is None:
+            from .parallel import ParallelExecutor
+            executor = ParallelExecutor(workers)
+
+        self._pipeline.executor = executor
         return self
 
     def peek(self, action):
@@ -230,17 +1083,91 @@ class Stream(object):
         Invoke ``action(e)`` for each element that passes through the
         stream at this point.
         """
-        def gen():
-            for i in self._iterable:
+        def gen(iterable):
+            for i in iterable:
                 action(i)
                 yield i
 
-        return self._make_stream(gen())
+        return self._chain(
+            gen(self._iterable),
+            self._characteristics & _SUBSET
+        )
+
+    def prefetch(self, n):
+        """
+        Returns a stream that pulls up to ``n`` elements ahead from this
+        stream on a background thread, so that a slow producer (network,
+        disk, decompression) runs concurrently with the stages after it.
+        Exceptions raised while producing are re-raised to the consumer.
+        The background thread is stopped when the returned stream is
+        closed or garbage collected, for example after ``limit``.
+        """
+        if n < 1:
+            raise ValueError("Prefetch buffer size must be at least 1")
+
+        self._not_checkpointable('prefetch')
+
+        return self._chain(
+            _prefetch(self._iterable, n),
+            self._characteristics & _SUBSET
+        )
+
+    def quantiles(self, qs, accuracy=0.01):
+        """
+        Returns a list of the approximate values at the quantiles ``qs``
+        (numbers between 0 and 1) of this stream, computed in bounded
+        memory with a :class:`~streams.sketches.QuantileSketch`::
+
+            >>> Stream(range(101)).quantiles([0.5])
+            [50]
+
+        This is a terminal operation.
+        """
+        self._no_saved_result('quantiles')
+        from .sketches import QuantileSketch
+        sketch = QuantileSketch(accuracy).update_all(self._iterable)
+        return sketch.quantiles(qs)
+
+    @classmethod
+    def resume(cls, store, *iterables):
+        """
+        Returns a new checkpointed stream of ``iterables``, starting from
+        the source position saved in ``store`` by a :meth:`checkpoint`
+        stage, or from the beginning if there is no saved checkpoint.
+        The pipeline built on this stream must be the same as the one
+        that saved the checkpoint.
+        """
+        from .checkpoint import Checkpointing
+        checkpointing = Checkpointing(store)
+        if len(iterables) == 1:
+            source = iterables[0]
+        else:
+            source = chain.from_iterable(iterables)
+
+        stream = cls._make_stream(checkpointing.source(source), ORDERED)
+        stream._pipeline = _Pipeline()
+        stream._pipeline.checkpointing = checkpointing
+        return stream
+
+    def sample(self, k, seed=None):
+        """
+        Returns a list of up to ``k`` elements of this stream chosen
+        uniformly at random by reservoir sampling. The ``seed`` is
+        passed to :class:`random.Random`.
+
+        This is a terminal operation.
+        """
+        self._no_saved_result('sample')
+        from .sketches import reservoir_sample
+        return reservoir_sample(self._iterable, k, seed)
 
     def sequential(self):
         """
         Convert the stream into a sequential stream.
         """
+        if self._pipeline is not None:
+            self._pipeline.executor = None
+
         return self
 
     def skip(self, n):
@@ -248,15 +1175,48 @@ class Stream(object):
         Skips ``n`` elements from this stream and return a stream
         of the rest.
         """
-        return self._make_stream(islice(self._iterable, n, None))
+        self._not_checkpointable('skip')
+        return self._chain(
+            islice(self._iterable, n, None),
+            self._characteristics & _SUBSET
+        )
 
     def sorted(self, key=None, reverse=False):
         """
         Sort the elements, as if by builtin `sorted`; return a new
         sequential stream whose elements are in the given sorted order.
+        A stream that is already in ascending natural order is returned
+        as is when sorted the same way. Under a memory budget, sorted runs
+        are spilled to temporary files and merged; otherwise, a parallel
+        stream sorts chunks on the worker processes and merges them.
         """
+        natural = key is None and not reverse
+        if natural and self._characteristics & SORTED:
+            return self
+
+        self._not_checkpointable('sorted')
+
+        flags = self._characteristics & DISTINCT | ORDERED
+        if natural:
+            flags |= SORTED
+
+        account = self._account('sorted')
+        if account is not None:
+            from .memory import external_sorted
+            return self._chain(
+                external_sorted(self._iterable, account, key, reverse),
+                flags
+            )
+
+        executor = self._executor_for(key)
+        if executor is not None:
+            return self._chain(
+                executor.sort(self._iterable, key, reverse),
+                flags
+            )
+
         new_data = sorted(self._iterable, key=key, reverse=reverse)
-        return self._make_stream(new_data)
+        return self._chain(new_data, flags | SIZED)
 
     def starmap(self, mapper):
         """
@@ -265,7 +1225,10 @@ class Stream(object):
             new_e = func(*old_e)
 
         """
-        return self._make_stream(starmap(mapper, self._iterable))
+        return self._chain(
+            starmap(mapper, self._iterable),
+            self._characteristics & ORDERED, stage=('starmap', mapper)
+        )
 
     def starapply_to(self, func):
         """
@@ -277,6 +1240,7 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        self._no_saved_result('starapply_to')
         return func(*self._iterable)
 
     def streammap(self, func):
@@ -296,6 +1260,17 @@ class Stream(object):
 
         This is a terminal operation.
         """
+        partials = self._distributed('sum')
+        if partials is not None:
+            return sum(partials)
+
+        state = self._terminal_state(0)
+        if state is not None:
+            for i in self._iterable:
+                state.value += i
+
+            return state.value
+
         return sum(self._iterable)
 
     def partition(self, predicate):
@@ -309,11 +1284,106 @@ class Stream(object):
             [0, 2, 4, 6, 8]
 
         """
-        s1, s2 = tee(self._iterable)
+        self._not_checkpointable('partition')
+        account = self._account('partition')
+        if account is not None:
+            s1, s2 = _spilling_tee(self._iterable, account)
+        else:
+            s1, s2 = tee(self._iterable)
+
+        flags = self._characteristics & _SUBSET
         return (
-            self._make_stream(s1).filter(lambda x: not predicate(x)),
-            self._make_stream(s2).filter(predicate)
+            self._chain(s1, flags, fresh=True)
+                .filter(lambda x: not predicate(x)),
+            self._chain(s2, flags, fresh=True).filter(predicate)
+        )
+
+    def unordered(self):
+        """
+        Returns this stream without the ``ORDERED`` characteristic,
+        declaring that the encounter order of the elements does not
+        matter to the consumer.
+        """
+        return self._chain(
+            self._iterable,
+            self._characteristics & ~ORDERED
+        )
+
+    def to_columns(self, schema, batch_size=4096):
+        """
+        Pack the records of this stream (dicts, or tuples in schema order)
+        into column batches of up to ``batch_size`` rows, and return them
+        as a :class:`~streams.columns.ColumnStream`. The ``schema`` maps
+        column names to :mod:`array` typecodes, or to None for columns of
+        arbitrary objects; use a sequence of ``(name, typecode)`` pairs to
+        fix the column order::
+
+            >>> rows = [(1, 'a'), (2, 'b'), (3, 'c')]
+            >>> Stream(rows).to_columns([('n', 'l'), ('s', None)]).sum('n')
+            6
+
+        """
+        self._no_saved_result('to_columns')
+        from .columns import ColumnStream
+        return ColumnStream.from_rows(
+            self._iterable, schema, batch_size, self._make_stream
         )
 
     def to_list(self):
+        self._no_saved_result('to_list')
+        partials = self._distributed('to_list')
+        if partials is not None:
+            return list(chain.from_iterable(partials))
+
         return list(self._iterable)
+
+    def top_k(self, k, key=None):
+        """
+        Returns a list of the ``k`` largest elements of this stream,
+        largest first, compared by ``key`` if given, as with
+        :func:`heapq.nlargest`::
+
+            >>> Stream([5, 1, 4, 2]).top_k(2)
+            [5, 4]
+
+        This is a terminal operation.
+        """
+        self._no_saved_result('top_k')
+        partials = self._distributed('top_k', k, key)
+        if partials is not None:
+            return nlargest(k, chain.from_iterable(partials), key=key)
+
+        return nlargest(k, self._iterable, key=key)
+
+
+_stream_init = Stream.__init__
+
+
+def _calibrate_unshared_refcount():
+    """
+    Return the reference count that a stream has in ``_chain`` when it
+    is a temporary that nothing else refers to, or -1 if that cannot be
+    told apart from a stream held in a variable.
+    """
+    if _getrefcount is None:
+        return -1
+
+    counts = []
+
+    class Probe(Stream):
+        __slots__ = ()
+
+        def _chain(self, iterable, characteristics, fresh=False, stage=None):
+            counts.append(_getrefcount(self))
+            return self
+
+    Probe([]).filter(None)
+    probe = Probe([])
+    probe.filter(None)
+    if counts[0] < counts[1]:
+        return counts[0]
+
+    return -1
+
+
+_UNSHARED_REFCOUNT = _calibrate_unshared_refcount()
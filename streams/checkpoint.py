@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointing of long-running pipelines.
+
+A pipeline that starts from :meth:`streams.Stream.resume` counts its
+position in the source, and a :meth:`streams.Stream.checkpoint` stage
+periodically writes that position, the state of the stateful operators
+(such as the elements seen by ``distinct``) and the accumulator of the
+terminal operation (``sum``, ``average`` or ``count``) to a store file.
+Building the same pipeline again with ``Stream.resume`` on the same
+store continues from the last checkpoint::
+
+    def job():
+        return Stream.resume('job.checkpoint', open('input.log', 'rb')) \\
+            .map(parse).distinct().checkpoint(every=10000).sum()
+
+A checkpoint is written when the stage after the checkpoint asks for
+the next element, that is, when everything downstream has finished
+with the previous elements; side effects of ``for_each`` are thus not
+repeated on resume. When the checkpoint stage reaches the end of the
+source, the store is cleared, so a job that completes does not affect
+the next job using the same store.
+
+Files are resumed by seeking to the saved offset, lists, tuples and
+ranges by index; other sources are skipped over element by element.
+
+Operators that read ahead of their consumers or keep state that is not
+saved (``sorted``, ``partition``, ``prefetch``, parallel stages,
+``limit``, ``skip``, slicing and ``enumerate``) cannot be used in a
+checkpointed pipeline.
+
+The terminal operation must be ``sum``, ``average`` or ``count``, whose
+accumulators are saved, or a consumer such as ``for_each`` or a ``for``
+loop, which after a resume sees only the elements after the checkpoint;
+other terminal operations, such as ``to_list`` or ``max``, raise
+ValueError on a pipeline created by ``Stream.resume``.
+"""
+from itertools import islice
+import os
+import pickle
+import zlib
+
+_FORMAT = 1
+
+_replace = getattr(os, 'replace', os.rename)
+
+#: Sources whose iterators are resumed by setting their index.
+_INDEXED = (list, tuple, type(range(0)))
+
+
+class CheckpointStore(object):
+    """
+    A file holding the latest checkpoint, as a compressed pickle. The
+    file is replaced atomically, so a crash while writing leaves the
+    previous checkpoint intact.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Return the saved checkpoint, or None if there is none.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+
+        except (IOError, OSError):
+            return None
+
+        checkpoint = pickle.loads(zlib.decompress(data))
+        if checkpoint.get('format') != _FORMAT:
+            raise ValueError("unsupported checkpoint in %r" % self.path)
+
+        return checkpoint
+
+    def save(self, checkpoint):
+        checkpoint = dict(checkpoint, format=_FORMAT)
+        data = pickle.dumps(checkpoint, pickle.HIGHEST_PROTOCOL)
+        data = zlib.compress(data)
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        _replace(temp, self.path)
+
+    def clear(self):
+        """
+        Remove the saved checkpoint.
+        """
+        try:
+            os.remove(self.path)
+
+        except OSError:
+            pass
+
+
+class State(object):
+    """
+    A piece of operator state saved with each checkpoint.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Checkpointing(object):
+    """
+    The checkpointing state of one pipeline: the store, the position in
+    the source and the registered operator states.
+    """
+
+    def __init__(self, store):
+        if not isinstance(store, CheckpointStore):
+            store = CheckpointStore(store)
+
+        self.store = store
+        self.loaded = store.load()
+        self.position = 0
+        self.states = []
+        self.terminal = None
+        self.stage = False
+        self.blocker = None
+        self._file = None
+
+    def source(self, iterable):
+        """
+        Return an iterator over ``iterable`` that starts at the saved
+        position and keeps track of the current one.
+        """
+        if self.loaded is not None:
+            self.position = self.loaded['source']
+
+        if all(hasattr(iterable, a) for a in ('readline', 'seek', 'tell')):
+            self._file = iterable
+            if self.loaded is not None:
+                iterable.seek(self.position)
+
+            return self._read_file(iterable)
+
+        it = iter(iterable)
+        if self.position:
+            if type(iterable) in _INDEXED and hasattr(it, '__setstate__'):
+                it.__setstate__(self.position)
+
+            else:
+                for _ in islice(it, self.position):
+                    pass
+
+        return self._count(it)
+
+    def _read_file(self, f):
+        # readline, unlike iteration, keeps tell() usable
+        return iter(f.readline, f.read(0))
+
+    def _count(self, it):
+        for element in it:
+            self.position += 1
+            yield element
+
+    def register(self, factory):
+        """
+        Register the state of a stateful operator, restored from the
+        loaded checkpoint if there is one, or created by ``factory``.
+        """
+        index = len(self.states)
+        if self.loaded is not None:
+            state = State(self.loaded['states'][index])
+
+        else:
+            state = State(factory())
+
+        self.states.append(state)
+        return state
+
+    def register_terminal(self, initial):
+        """
+        Register the accumulator of the terminal operation.
+        """
+        value = initial
+        if self.loaded is not None and self.loaded['terminal'] is not None:
+            value = self.loaded['terminal']
+
+        self.terminal = State(value)
+        return self.terminal
+
+    def passed(self):
+        """
+        Return the number of elements passed by the checkpoint stage
+        before the loaded checkpoint.
+        """
+        if self.loaded is None:
+            return 0
+
+        return self.loaded['passed']
+
+    def complete(self):
+        """
+        Remove the checkpoint once the source has been read to the end,
+        so that the next job using the same store starts from the
+        beginning.
+        """
+        self.store.clear()
+        self.loaded = None
+
+    def save(self, passed):
+        if self._file is not None:
+            self.position = self._file.tell()
+
+        self.store.save({
+            'source': self.position,
+            'passed': passed,
+            'states': [state.value for state in self.states],
+            'terminal': self.terminal and self.terminal.value,
+        })
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Column-oriented batches of records.
+
+A stream of small records (dicts or tuples) spends most of its memory on
+per-object overhead. :meth:`streams.Stream.to_columns` packs the records
+into :class:`ColumnBatch` objects that store each column in an
+:class:`array.array`, and returns a :class:`ColumnStream` whose
+projections, filters and reductions work on whole columns at a time::
+
+    >>> rows = [{'x': 1, 'y': 2.5}, {'x': 2, 'y': 0.5}, {'x': 3, 'y': 1.0}]
+    >>> columns = Stream(rows).to_columns({'x': 'l', 'y': 'd'})
+    >>> columns.where('x', lambda x: x > 1).sum('y')
+    1.5
+
+"""
+from __future__ import division
+from array import array
+from itertools import compress, islice
+from operator import itemgetter
+
+_OBJECT = (None, 'O')
+
+
+def _normalize_schema(schema):
+    """
+    Return the schema as a tuple of ``(name, typecode)`` pairs; a typecode
+    of None stores the column as a list of arbitrary objects.
+    """
+    if hasattr(schema, 'items'):
+        schema = schema.items()
+
+    result = []
+    for name, typecode in schema:
+        if typecode in _OBJECT:
+            typecode = None
+
+        else:
+            # validate the typecode early, not at the first batch
+            array(typecode)
+
+        result.append((name, typecode))
+
+    return tuple(result)
+
+
+def _make_column(typecode, values):
+    if typecode is None:
+        return list(values)
+
+    return array(typecode, values)
+
+
+class ColumnBatch(object):
+    """
+    A batch of records stored as one sequence per column. Columns with a
+    typecode are :class:`array.array` instances, other columns are lists.
+    """
+
+    def __init__(self, schema, columns):
+        self.schema = schema
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, schema, rows):
+        """
+        Pack a list of records into a batch. Records are either mappings,
+        accessed by column name, or sequences in schema order.
+        """
+        names = [name for name, _ in schema]
+        if rows and hasattr(rows[0], 'keys'):
+            if len(names) == 1:
+                rows = [(row[names[0]],) for row in rows]
+
+            else:
+                getter = itemgetter(*names)
+                rows = [getter(row) for row in rows]
+
+        if rows:
+            values = zip(*rows)
+
+        else:
+            values = [()] * len(schema)
+
+        columns = dict(
+            (name, _make_column(typecode, column))
+            for (name, typecode), column in zip(schema, values)
+        )
+        return cls(schema, columns)
+
+    def __len__(self):
+        if not self.schema:
+            return 0
+
+        return len(self.columns[self.schema[0][0]])
+
+    def __getitem__(self, name):
+        """
+        Return the column called ``name``.
+        """
+        return self.columns[name]
+
+    @property
+    def names(self):
+        return [name for name, _ in self.schema]
+
+    def select(self, names):
+        """
+        Return a batch with only the given columns.
+        """
+        schema = dict(self.schema)
+        return ColumnBatch(
+            tuple((name, schema[name]) for name in names),
+            dict((name, self.columns[name]) for name in names)
+        )
+
+    def compress(self, mask):
+        """
+        Return a batch with only the rows for which ``mask`` is true.
+        """
+        return ColumnBatch(self.schema, dict(
+            (name, _make_column(typecode, compress(self.columns[name], mask)))
+            for name, typecode in self.schema
+        ))
+
+    def rows(self, tuples=False):
+        """
+        Iterate over the records in this batch, as dicts or, if ``tuples``
+        is true, as tuples in schema order.
+        """
+        names = self.names
+        rows = zip(*[self.columns[name] for name in names])
+        if tuples:
+            return iter(rows)
+
+        return (dict(zip(names, row)) for row in rows)
+
+
+class ColumnStream(object):
+    """
+    A stream of :class:`ColumnBatch` objects with column-wise operations.
+    ``make_stream`` converts iterables back into row streams; it is the
+    ``_make_stream`` of the stream that created this one.
+    """
+
+    def __init__(self, batches, make_stream):
+        self._batches = batches
+        self._make_stream = make_stream
+
+    @classmethod
+    def from_rows(cls, iterable, schema, batch_size, make_stream):
+        schema = _normalize_schema(schema)
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+
+        def gen():
+            it = iter(iterable)
+            while True:
+                rows = list(islice(it, batch_size))
+                if not rows:
+                    return
+
+                yield ColumnBatch.from_rows(schema, rows)
+
+        return cls(gen(), make_stream)
+
+    def __iter__(self):
+        """
+        Returns an iterator over the batches of this stream.
+        """
+        return iter(self._batches)
+
+    def batches(self):
+        """
+        Returns a stream of the :class:`ColumnBatch` objects.
+        """
+        return self._make_stream(self._batches)
+
+    def select(self, *names):
+        """
+        Returns a column stream with only the named columns.
+        """
+        return ColumnStream(
+            (batch.select(names) for batch in self._batches),
+            self._make_stream
+        )
+
+    def where(self, name, predicate):
+        """
+        Returns a column stream of the rows for which ``predicate``
+        is true for the value in column ``name``. The mask is computed
+        from that column alone and applied to every column.
+        """
+        def gen():
+            for batch in self._batches:
+                mask = list(map(predicate, batch[name]))
+                if all(mask):
+                    yield batch
+
+                elif any(mask):
+                    yield batch.compress(mask)
+
+        return ColumnStream(gen(), self._make_stream)
+
+    def column(self, name):
+        """
+        Returns a stream of the values in column ``name``.
+        """
+        return self._make_stream(
+            value for batch in self._batches for value in batch[name]
+        )
+
+    def to_rows(self, tuples=False):
+        """
+        Returns a stream of the records as dicts, or as tuples in schema
+        order if ``tuples`` is true.
+        """
+        return self._make_stream(
+            row for batch in self._batches for row in batch.rows(tuples)
+        )
+
+    def count(self):
+        """
+        Returns the number of rows.
+
+        This is a terminal operation.
+        """
+        return sum(len(batch) for batch in self._batches)
+
+    def sum(self, name):
+        """
+        Returns the sum of column ``name``.
+
+        This is a terminal operation.
+        """
+        return sum(sum(batch[name]) for batch in self._batches)
+
+    def average(self, name):
+        """
+        Returns the numeric average of column ``name``.
+
+        This is a terminal operation.
+        """
+        total = 0
+        number = 0
+        for batch in self._batches:
+            total += sum(batch[name])
+            number += len(batch)
+
+        return total / number
+
+    def min(self, name):
+        """
+        Returns the minimum value of column ``name``.
+
+        This is a terminal operation.
+        """
+        return min(min(batch[name]) for batch in self._batches if len(batch))
+
+    def max(self, name):
+        """
+        Returns the maximum value of column ``name``.
+
+        This is a terminal operation.
+        """
+        return max(max(batch[name]) for batch in self._batches if len(batch))
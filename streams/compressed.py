@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Reading records from compressed files on background threads.
+
+:meth:`streams.Stream.from_compressed` reads ``.gz``, ``.bz2`` and
+``.xz`` files in blocks of ``block_size`` bytes and decompresses them on
+background threads; the decompressors of :mod:`zlib`, :mod:`bz2` and
+:mod:`lzma` release the GIL while they work, so decompression runs
+concurrently with the stages of the stream. Each decompressed block is
+split into lines with a single call, and the lines are handed to the
+stream a block at a time.
+
+With several files, up to ``threads`` files are read concurrently, one
+file per thread, and the lines of the files are interleaved block by
+block as they become ready; the lines of each file stay in order.
+"""
+from functools import partial
+from io import BytesIO, StringIO
+from threading import Event, Thread
+import zlib
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from . import _put_until, _drain, _ITEM, _ERROR, _DONE
+
+#: Codec names by the magic bytes that start the compressed files.
+_MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+
+CODECS = ('gz', 'bz2', 'xz', None)
+
+
+def detect_codec(path):
+    """
+    Return the codec of the file at ``path`` from its first bytes:
+    ``'gz'``, ``'bz2'``, ``'xz'``, or None for an uncompressed file.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+
+    for magic, codec in _MAGIC:
+        if head.startswith(magic):
+            return codec
+
+    return None
+
+
+def _decompressor(codec):
+    if codec == 'gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    if codec == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+
+    import lzma
+    return lzma.LZMADecompressor()
+
+
+def decompressed_blocks(f, codec, block_size):
+    """
+    Yield the decompressed contents of the binary file ``f``, read in
+    blocks of ``block_size`` bytes. Files of several concatenated
+    compressed streams, as written by ``cat a.gz b.gz``, are read to
+    the end. Raises EOFError if the last stream is truncated.
+    """
+    blocks = iter(partial(f.read, block_size), b'')
+    if codec is None:
+        for block in blocks:
+            yield block
+
+        return
+
+    decompressor = None
+    for raw in blocks:
+        while raw:
+            if decompressor is None:
+                decompressor = _decompressor(codec)
+
+            data = decompressor.decompress(raw)
+            if data:
+                yield data
+
+            raw = b''
+            if decompressor.eof:
+                raw = decompressor.unused_data
+                decompressor = None
+
+    if decompressor is not None:
+        raise EOFError(
+            "compressed file ended before the end-of-stream marker"
+        )
+
+
+def _split_lines(data, encoding):
+    if encoding is None:
+        return BytesIO(data).readlines()
+
+    return StringIO(data.decode(encoding), newline='\n').readlines()
+
+
+def line_blocks(blocks, encoding=None):
+    """
+    Yield lists of the lines, newline included, in ``blocks`` of bytes;
+    lines are decoded with ``encoding`` if it is given. Each block is
+    split at once, and a line that continues into the next block is
+    carried over to it.
+    """
+    partial_line = []
+    for block in blocks:
+        end = block.rfind(b'\n') + 1
+        if not end:
+            partial_line.append(block)
+            continue
+
+        if partial_line:
+            partial_line.append(block[:end])
+            data = b''.join(partial_line)
+
+        else:
+            data = block[:end]
+
+        partial_line = [block[end:]] if end < len(block) else []
+        yield _split_lines(data, encoding)
+
+    if partial_line:
+        yield _split_lines(b''.join(partial_line), encoding)
+
+
+def _read_file(path, codec, block_size, encoding):
+    if codec == 'auto':
+        codec = detect_codec(path)
+
+    with open(path, 'rb') as f:
+        for lines in line_blocks(
+                decompressed_blocks(f, codec, block_size), encoding):
+            yield lines
+
+
+def read_lines(paths, codec='auto', threads=1, block_size=1 << 20,
+               encoding=None):
+    """
+    Yield the lines of the files at ``paths``, read on ``threads``
+    background threads; see :meth:`streams.Stream.from_compressed`.
+    Exceptions raised while reading are re-raised to the consumer; when
+    the consumer stops early, the threads stop after their current block.
+    """
+    files = Queue()
+    for path in paths:
+        files.put(path)
+
+    queue = Queue(2 * threads)
+    stop = Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                try:
+                    path = files.get_nowait()
+
+                except Empty:
+                    break
+
+                for lines in _read_file(path, codec, block_size, encoding):
+                    if not _put_until(queue, (_ITEM, lines), stop):
+                        return
+
+            _put_until(queue, (_DONE, None), stop)
+
+        except BaseException as e:
+            _put_until(queue, (_ERROR, e), stop)
+
+    for _ in range(threads):
+        thread = Thread(target=reader, name='streams-decompress')
+        thread.daemon = True
+        thread.start()
+
+    running = threads
+    try:
+        while running:
+            kind, value = queue.get()
+            if kind == _ITEM:
+                for line in value:
+                    yield line
+
+            elif kind == _ERROR:
+                raise value
+
+            else:
+                running -= 1
+
+    finally:
+        stop.set()
+        _drain(queue)
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+Distributed execution of stream pipelines on worker servers.
+
+A worker server is a standalone Python process that accepts connections
+over TCP and runs pipeline tasks; start one on each machine with::
+
+    STREAMS_AUTHKEY=secret python -m streams.distributed --host 0.0.0.0 --port 7500
+
+Connections are authenticated with the shared key in ``STREAMS_AUTHKEY``,
+but tasks are sent as pickles, so workers must only be reachable from
+trusted hosts. The functions of the pipeline are pickled by reference,
+so the workers must be able to import the modules that define them.
+
+:meth:`streams.Stream.distributed` splits the source of a stream into
+partitions, slices of a sized sequence or byte ranges of a file that
+the workers can open, and sends each partition to a worker of a
+:class:`Cluster` together with the ``map``, ``filter`` and ``starmap``
+stages of the pipeline. The terminal operation runs on the workers, and
+the results of the partitions are combined in partition order::
+
+    with LocalCluster(4) as cluster:
+        Stream(open('input.log', 'rb')).distributed(cluster) \\
+            .map(parse).filter(is_error).count()
+
+The terminal operations that are distributed are ``count``, ``sum``,
+``collect``, ``top_k``, ``group_by`` and ``to_list``. A pipeline with
+other stages, or with functions that cannot be pickled, runs locally.
+When a worker fails, its partition is run again on another worker.
+"""
+from collections import deque
+from threading import Condition, Thread
+import binascii
+import io
+import os
+import pickle
+import subprocess
+import sys
+
+from multiprocessing.connection import Client, Listener
+
+#: The environment variable holding the key shared by a cluster.
+AUTHKEY_VARIABLE = 'STREAMS_AUTHKEY'
+
+#: File objects whose name is a path that the workers can open.
+_FILE_TYPES = (io.FileIO, io.BufferedReader, io.TextIOWrapper)
+
+
+def _default_authkey():
+    key = os.environ.get(AUTHKEY_VARIABLE)
+    if not key:
+        raise ValueError(
+            "an authkey is needed, or the %s environment variable"
+            % AUTHKEY_VARIABLE
+        )
+
+    return key.encode('ascii')
+
+
+class FilePartition(object):
+    """
+    The lines of the file at ``path`` that start at byte offsets from
+    ``start`` up to ``end``. Lines are bytes, or text decoded with
+    ``encoding`` if it is given.
+    """
+
+    def __init__(self, path, start, end, encoding=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.encoding = encoding
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            if self.start:
+                # the line that crosses the start offset belongs to the
+                # previous partition
+                f.seek(self.start - 1)
+                f.readline()
+
+            while f.tell() < self.end:
+                line = f.readline()
+                if not line:
+                    return
+
+                if self.encoding is not None:
+                    line = line.decode(self.encoding)
+
+                yield line
+
+
+def split(source, n):
+    """
+    Split ``source``, a sized sequence or a file returned by the builtin
+    :func:`open`, into up to ``n`` partitions. Raises ValueError for other
+    sources, including compressed files.
+    """
+    path = getattr(source, 'name', None)
+    if type(source) in _FILE_TYPES and isinstance(path, str):
+        encoding = None
+        if isinstance(source, io.TextIOWrapper):
+            encoding = source.encoding
+
+        start = source.tell()
+        size = os.path.getsize(path) - start
+        bounds = [start + size * i // n for i in range(n + 1)]
+        return [
+            FilePartition(path, bounds[i], bounds[i + 1], encoding)
+            for i in range(n)
+        ]
+
+    if hasattr(source, '__len__') and hasattr(source, '__getitem__') \
+            and not hasattr(source, 'keys'):
+        size = len(source)
+        n = max(1, min(n, size))
+        bounds = [size * i // n for i in range(n + 1)]
+        return [source[bounds[i]:bounds[i + 1]] for i in range(n)]
+
+    raise ValueError(
+        "distributed streams need a sized sequence or a file as the source"
+    )
+
+
+def run_task(partition, stages, terminal, args):
+    """
+    Run the ``stages`` of a pipeline and the ``terminal`` operation on
+    one partition; this is what the workers do for each task.
+    """
+    from . import Stream
+    stream = Stream(partition)
+    for method, func in stages:
+        stream = getattr(stream, method)(func)
+
+    return getattr(stream, terminal)(*args)
+
+
+def _handle(conn):
+    with conn:
+        while True:
+            try:
+                task = conn.recv()
+
+            except (EOFError, OSError):
+                return
+
+            except Exception as e:
+                # the task cannot be unpickled here, for example because
+                # it refers to a module that this worker cannot import
+                conn.send(('error', e))
+                continue
+
+            try:
+                result = 'ok', run_task(*task)
+
+            except Exception as e:
+                result = 'error', e
+
+            try:
+                conn.send(result)
+
+            except (EOFError, OSError):
+                return
+
+            except Exception as e:
+                # the result or the exception cannot be pickled
+                conn.send(('error', RuntimeError(
+                    "cannot send the result of a task: %r" % e
+                )))
+
+
+def serve(host='127.0.0.1', port=0, authkey=None, ready=None):
+    """
+    Run a worker server on ``host`` and ``port`` until the process is
+    killed. Each connection is served on a thread of its own. If
+    ``ready`` is given, it is called with the ``(host, port)`` address
+    once the server is listening.
+    """
+    if authkey is None:
+        authkey = _default_authkey()
+
+    listener = Listener((host, port), authkey=authkey)
+    if ready is not None:
+        ready(listener.address)
+
+    while True:
+        try:
+            conn = listener.accept()
+
+        except Exception:
+            # failed handshakes only affect the client that made them
+            continue
+
+        thread = Thread(target=_handle, args=(conn,), name='streams-worker')
+        thread.daemon = True
+        thread.start()
+
+
+class Cluster(object):
+    """
+    The worker servers at ``addresses``, a list of ``(host, port)``
+    pairs, sharing the key ``authkey`` (by default taken from the
+    ``STREAMS_AUTHKEY`` environment variable). Sources are split into
+    ``partitions_per_worker`` partitions per worker, so that the work of
+    a failed worker can be spread over the others.
+    """
+
+    def __init__(self, addresses, authkey=None, partitions_per_worker=4):
+        if authkey is None:
+            authkey = _default_authkey()
+
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self.partitions_per_worker = partitions_per_worker
+        self.failures = []
+
+    @property
+    def default_partitions(self):
+        return self.partitions_per_worker * len(self.addresses)
+
+    def run(self, partitions, stages, terminal, args=()):
+        """
+        Run ``run_task`` for each of ``partitions`` on the workers, and
+        return the results in partition order. A partition whose worker
+        fails or cannot be reached is rescheduled on another worker;
+        RuntimeError is raised if no worker is left. An exception raised
+        by a task is re-raised here.
+        """
+        pending = deque(enumerate(partitions))
+        results = {}
+        errors = []
+        state = {'alive': len(self.addresses)}
+        condition = Condition()
+
+        def finished():
+            return errors or len(results) == len(partitions)
+
+        def work(address):
+            try:
+                conn = Client(address, authkey=self.authkey)
+
+            except Exception as e:
+                with condition:
+                    self.failures.append((address, e))
+                    state['alive'] -= 1
+                    condition.notify_all()
+
+                return
+
+            with conn:
+                while True:
+                    with condition:
+                        while not pending and not finished():
+                            condition.wait()
+
+                        if finished():
+                            return
+
+                        index, partition = pending.popleft()
+
+                    try:
+                        conn.send((partition, stages, terminal, args))
+                        status, value = conn.recv()
+
+                    except (EOFError, OSError) as e:
+                        with condition:
+                            self.failures.append((address, e))
+                            pending.appendleft((index, partition))
+                            state['alive'] -= 1
+                            condition.notify_all()
+
+                        return
+
+                    except Exception as e:
+                        status, value = 'error', e
+
+                    with condition:
+                        if status == 'ok':
+                            results[index] = value
+
+                        else:
+                            errors.append(value)
+
+                        condition.notify_all()
+
+        threads = [
+            Thread(target=work, args=(address,), name='streams-client')
+            for address in self.addresses
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        with condition:
+            while not finished() and state['alive']:
+                condition.wait()
+
+            if errors:
+                raise errors[0]
+
+            if not finished():
+                raise RuntimeError("all workers of the cluster failed")
+
+        return [results[i] for i in range(len(partitions))]
+
+
+class LocalCluster(Cluster):
+    """
+    A cluster of ``workers`` worker servers started as subprocesses on
+    this machine, with a random key. The workers can import the same
+    modules as this process. Use as a context manager, or call
+    :meth:`close` to stop the workers.
+    """
+
+    def __init__(self, workers=2, partitions_per_worker=4):
+        authkey = binascii.hexlify(os.urandom(16))
+        env = dict(os.environ)
+        env[AUTHKEY_VARIABLE] = authkey.decode('ascii')
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+        self.processes = []
+        addresses = []
+        try:
+            for _ in range(workers):
+                process = subprocess.Popen(
+                    [sys.executable, '-m', 'streams.distributed'],
+                    stdout=subprocess.PIPE, env=env
+                )
+                self.processes.append(process)
+                host, port = process.stdout.readline().decode().split()
+                addresses.append((host, int(port)))
+
+        except Exception:
+            self.close()
+            raise
+
+        super(LocalCluster, self).__init__(
+            addresses, authkey, partitions_per_worker
+        )
+
+    def close(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+
+            process.wait()
+            process.stdout.close()
+
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DistributedPlan(object):
+    """
+    The partitions and the stages of a distributed pipeline. Plans are
+    not changed once created: :meth:`then` returns the plan of the next
+    stage, so that streams derived from the same stream do not share
+    their stages. A plan with a stage that the workers cannot run is
+    ``local``, and its pipeline runs locally.
+    """
+
+    def __init__(self, cluster, source, partitions=None):
+        self.cluster = cluster
+        self.partitions = split(
+            source, partitions or cluster.default_partitions
+        )
+        self.stages = ()
+        self.local = False
+
+    def then(self, stage):
+        """
+        Return the plan with ``stage``, a ``(method, func)`` pair, added
+        after the stages of this plan; None stands for a stage that only
+        runs locally.
+        """
+        plan = object.__new__(DistributedPlan)
+        plan.cluster = self.cluster
+        plan.partitions = self.partitions
+        plan.stages = self.stages
+        plan.local = self.local
+        if stage is not None and not plan.local and _picklable(stage[1]):
+            plan.stages += (stage,)
+
+        else:
+            plan.local = True
+
+        return plan
+
+    def can_run(self, args):
+        return not self.local and _picklable(args)
+
+    def run(self, terminal, args):
+        return self.cluster.run(self.partitions, self.stages, terminal, args)
+
+
+def _picklable(obj):
+    try:
+        pickle.dumps(obj)
+
+    except Exception:
+        return False
+
+    return True
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Run a streams worker server; the key shared by the "
+                    "cluster is read from %s." % AUTHKEY_VARIABLE
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    options = parser.parse_args(argv)
+
+    def ready(address):
+        # LocalCluster reads the address from the first line
+        sys.stdout.write('%s %d\n' % address)
+        sys.stdout.flush()
+
+    serve(options.host, options.port, ready=ready)
+
+
+if __name__ == '__main__':
+    main()
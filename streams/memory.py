@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Memory accounting for stateful stream operators.
+
+A :class:`MemoryBudget` limits the approximate number of bytes that the
+stateful operators of one or more pipelines may buffer. Each operator
+opens a :class:`MemoryAccount` on the budget and reserves memory for
+the elements it holds; when a reservation is refused, the operator
+falls back to a mode that does not need more memory:
+
+* ``sorted`` spills sorted runs to temporary files and merges them,
+* ``partition`` spills the elements buffered for the other partition
+  to a temporary file,
+* ``distinct`` switches to a Bloom filter, which may drop a small
+  fraction of distinct elements.
+
+Sizes are estimated with :func:`sys.getsizeof`, which does not follow
+references, so the budget is an approximation.
+"""
+from __future__ import division
+from collections import deque
+from heapq import merge
+from math import log
+from threading import Lock
+from tempfile import TemporaryFile
+import pickle
+import sys
+
+#: Approximate cost of a reference in a list, deque or set, in bytes.
+_SLOT_SIZE = 16
+
+_MASK64 = (1 << 64) - 1
+
+#: Sorted runs are spilled only when they have at least this many
+#: elements, even if the budget is used up by other operators.
+_MIN_RUN = 1024
+
+#: At most this many spilled runs are kept open; when there are more,
+#: they are merged into one.
+_MAX_RUNS = 64
+
+
+def element_size(element):
+    """
+    Return the approximate number of bytes used for holding ``element``
+    in a container.
+    """
+    return sys.getsizeof(element) + _SLOT_SIZE
+
+
+class MemoryAccount(object):
+    """
+    The memory held by one operator under a :class:`MemoryBudget`.
+    """
+
+    def __init__(self, budget, name):
+        self.budget = budget
+        self.name = name
+        self.used = 0
+        self.peak = 0
+
+    def reserve(self, nbytes):
+        """
+        Reserve ``nbytes`` more for this operator. Returns False, without
+        reserving anything, if that would exceed the budget.
+        """
+        with self.budget._lock:
+            if self.budget.used + nbytes > self.budget.limit:
+                return False
+
+            self.budget.used += nbytes
+            self.used += nbytes
+            if self.used > self.peak:
+                self.peak = self.used
+
+            if self.budget.used > self.budget.peak:
+                self.budget.peak = self.budget.used
+
+        return True
+
+    def release(self, nbytes=None):
+        """
+        Release ``nbytes``, or everything reserved by this operator.
+        """
+        with self.budget._lock:
+            if nbytes is None or nbytes > self.used:
+                nbytes = self.used
+
+            self.used -= nbytes
+            self.budget.used -= nbytes
+
+
+class MemoryBudget(object):
+    """
+    A limit of ``limit`` bytes shared by the stateful operators of the
+    pipelines that use this budget.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.accounts = []
+        self._names = {}
+        self._lock = Lock()
+
+    def account(self, name):
+        """
+        Open an account for an operator called ``name``.
+        """
+        with self._lock:
+            number = self._names.get(name, 0) + 1
+            self._names[name] = number
+            if number > 1:
+                name = '%s-%d' % (name, number)
+
+            account = MemoryAccount(self, name)
+            self.accounts.append(account)
+
+        return account
+
+    def report(self):
+        """
+        Return a dictionary of the peak number of bytes held by each
+        operator, by operator name.
+        """
+        return dict((a.name, a.peak) for a in self.accounts)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of ``nbits`` bits using ``hashes`` hash functions;
+    hashing uses the builtin :func:`hash` of the elements.
+    """
+
+    def __init__(self, nbits, hashes=7):
+        self.nbits = max(64, nbits)
+        self.hashes = hashes
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """
+        Return a filter that holds ``capacity`` elements with a false
+        positive rate of about ``error_rate``.
+        """
+        nbits = int(-capacity * log(error_rate) / (log(2) ** 2))
+        hashes = max(1, int(round(nbits / capacity * log(2))))
+        return cls(nbits, hashes)
+
+    def _indices(self, element):
+        h = (hash(element) * 0x9E3779B97F4A7C15) & _MASK64
+        h1 = h >> 32
+        h2 = (h & 0xFFFFFFFF) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, element):
+        """
+        Add ``element``; returns True if it was possibly there already.
+        """
+        present = True
+        bits = self.bits
+        for index in self._indices(element):
+            byte, bit = index >> 3, 1 << (index & 7)
+            if not bits[byte] & bit:
+                present = False
+                bits[byte] |= bit
+
+        return present
+
+
+class SpillQueue(object):
+    """
+    A FIFO queue that keeps its elements in memory while the account
+    allows, and appends the rest to a temporary file.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.memory = deque()
+        self.sizes = deque()
+        self.file = None
+        self.pending = 0
+        self.spilled = 0
+        self.closed = False
+        self._read_pos = 0
+
+    def __len__(self):
+        return len(self.memory) + self.pending
+
+    def append(self, element):
+        if self.file is None:
+            size = element_size(element)
+            if self.account.reserve(size):
+                self.memory.append(element)
+                self.sizes.append(size)
+                return
+
+            self.file = TemporaryFile()
+
+        self.file.seek(0, 2)
+        pickle.dump(element, self.file, pickle.HIGHEST_PROTOCOL)
+        self.pending += 1
+        self.spilled += 1
+
+    def popleft(self):
+        if self.memory:
+            self.account.release(self.sizes.popleft())
+            return self.memory.popleft()
+
+        if not self.pending:
+            raise IndexError("pop from an empty queue")
+
+        self.file.seek(self._read_pos)
+        element = pickle.load(self.file)
+        self._read_pos = self.file.tell()
+        self.pending -= 1
+        if not self.pending:
+            self.file.close()
+            self.file = None
+            self._read_pos = 0
+
+        return element
+
+    def close(self):
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        self.account.release(sum(self.sizes))
+        self.memory.clear()
+        self.sizes.clear()
+
+
+def _write_run(run):
+    f = TemporaryFile()
+    for element in run:
+        pickle.dump(element, f, pickle.HIGHEST_PROTOCOL)
+
+    f.seek(0)
+    return f
+
+
+def _read_run(f, count):
+    try:
+        for _ in range(count):
+            yield pickle.load(f)
+
+    finally:
+        f.close()
+
+
+def _merge_runs(runs, key, reverse):
+    """
+    Merge the spilled ``runs`` into a single run, in one pass.
+    """
+    readers = [_read_run(f, count) for f, count in runs]
+    count = sum(count for _, count in runs)
+    del runs[:]
+    return _write_run(merge(*readers, key=key, reverse=reverse)), count
+
+
+def external_sorted(iterable, account, key=None, reverse=False):
+    """
+    Yield the elements of ``iterable`` as sorted by the builtin
+    ``sorted``. Elements are collected into a run while ``account``
+    allows, and runs of at least ``_MIN_RUN`` elements that do not fit
+    are sorted and spilled to temporary files. When there are more than
+    ``_MAX_RUNS`` spilled runs they are merged into one, and the runs are
+    merged lazily at the end. The merges are stable, so the result is
+    identical to ``sorted(iterable, key=key, reverse=reverse)``.
+    """
+    runs = []
+    run = []
+    try:
+        for element in iterable:
+            if not account.reserve(element_size(element)) \
+                    and len(run) >= _MIN_RUN:
+                run.sort(key=key, reverse=reverse)
+                runs.append((_write_run(run), len(run)))
+                run = []
+                account.release()
+                account.reserve(element_size(element))
+                if len(runs) >= _MAX_RUNS:
+                    runs.append(_merge_runs(runs, key, reverse))
+
+            run.append(element)
+
+        run.sort(key=key, reverse=reverse)
+        if not runs:
+            for element in run:
+                yield element
+
+            return
+
+        readers = [_read_run(f, count) for f, count in runs]
+        runs = []
+        for element in merge(*(readers + [iter(run)]),
+                             key=key, reverse=reverse):
+            yield element
+
+    finally:
+        for f, _ in runs:
+            f.close()
+
+        account.release()
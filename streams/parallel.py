@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Process-pool execution of stateless stream stages.
+
+A :class:`ParallelExecutor` runs ``map`` and ``filter`` stages of a
+parallel stream on worker processes. Elements are sent to the workers in
+chunks whose size adapts to the measured cost per element: each worker
+times the chunks it runs, and the executor sizes the following chunks so
+that one chunk takes about ``target_chunk_time`` seconds. Cheap functions
+thus end up with large chunks that amortize the inter-process overhead,
+and expensive ones with small chunks that spread evenly over the workers.
+
+Chunks are queued to the pool and taken by whichever worker is idle, and
+a few more chunks than there are workers are kept queued, so a worker
+that finishes early never waits for a busy one.
+
+Sorting is done by sorting chunks of the input on the workers and merging
+the sorted runs lazily in the parent.
+"""
+from __future__ import division
+from collections import deque
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+from multiprocessing import cpu_count
+from threading import Lock
+from time import time
+import pickle
+
+try:
+    from concurrent.futures import (
+        ProcessPoolExecutor, wait, FIRST_COMPLETED
+    )
+except ImportError:
+    ProcessPoolExecutor = None
+
+
+def _run_chunk(func, filtering, chunk, packed=False):
+    """
+    Run one chunk in a worker. Returns the results and the time spent;
+    for a filter the results are the indices of the accepted elements,
+    so that the elements themselves need not be sent back. If ``packed``
+    is true, the elements are packed by a transport.
+    """
+    start = time()
+    if not packed:
+        if filtering:
+            result = [i for i, element in enumerate(chunk) if func(element)]
+
+        else:
+            result = [func(element) for element in chunk]
+
+    elif filtering:
+        result = []
+        for i, item in enumerate(chunk):
+            with item as element:
+                if func(element):
+                    result.append(i)
+
+    else:
+        result = []
+        for item in chunk:
+            with item as element:
+                result.append(func(element))
+
+    return result, time() - start
+
+
+def _sort_chunk(chunk, key, reverse):
+    """
+    Sort one chunk in a worker. With a key function the result is a list
+    of ``(key, element)`` pairs, so that the parent can merge the runs
+    without calling the key again.
+    """
+    if key is None:
+        chunk.sort(reverse=reverse)
+        return chunk
+
+    decorated = [(key(element), element) for element in chunk]
+    decorated.sort(key=itemgetter(0), reverse=reverse)
+    return decorated
+
+
+class ChunkSizer(object):
+    """
+    Chooses chunk sizes from the measured per-element cost. The size
+    starts at ``initial_size`` and grows at most fourfold per measured
+    chunk, so the first few chunks are small timing probes.
+    """
+
+    def __init__(self, target_chunk_time=0.05, initial_size=1,
+                 max_size=100000, history=1000):
+        self.target_chunk_time = target_chunk_time
+        self.max_size = max_size
+        self.size = initial_size
+        self.cost = None
+        self.history = deque(maxlen=history)
+
+    def observe(self, n, elapsed):
+        """
+        Record that a chunk of ``n`` elements took ``elapsed`` seconds,
+        and update the chunk size.
+        """
+        self.history.append((n, elapsed))
+        if not n:
+            return
+
+        cost = elapsed / n
+        if self.cost is None:
+            self.cost = cost
+
+        else:
+            self.cost = (self.cost + cost) / 2
+
+        if self.cost > 0:
+            ideal = int(self.target_chunk_time / self.cost)
+
+        else:
+            ideal = self.max_size
+
+        self.size = max(1, min(ideal, self.size * 4, self.max_size))
+
+
+class ParallelExecutor(object):
+    """
+    Runs stateless stages on a pool of ``workers`` processes (by default
+    one per CPU) in adaptively sized chunks. The pool is started when the
+    first stage starts and shut down when the last running stage ends.
+
+    If a :class:`~streams.transport.Transport` is given, elements that are
+    large buffers are sent through shared memory, and the stage function
+    receives a read-only view of them.
+    """
+
+    def __init__(self, workers=None, target_chunk_time=0.05,
+                 max_chunk_size=100000, transport=None,
+                 sort_chunk_size=65536):
+        self.workers = workers or cpu_count()
+        self.target_chunk_time = target_chunk_time
+        self.max_chunk_size = max_chunk_size
+        self.transport = transport
+        self.sort_chunk_size = sort_chunk_size
+        self.sizers = []
+        self._pool = None
+        self._users = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def can_run(func):
+        """
+        Returns True if ``func`` can be sent to worker processes.
+        """
+        if ProcessPoolExecutor is None:
+            return False
+
+        try:
+            pickle.dumps(func)
+
+        except Exception:
+            return False
+
+        return True
+
+    def _acquire_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers)
+
+            self._users += 1
+            return self._pool
+
+    def _release_pool(self):
+        with self._lock:
+            self._users -= 1
+            if not self._users:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+    def _pack(self, chunk):
+        if self.transport is None:
+            return chunk
+
+        return [self.transport.pack(element) for element in chunk]
+
+    def _release(self, packed):
+        if self.transport is not None:
+            for element in packed:
+                self.transport.release(element)
+
+    def run(self, func, iterable, filtering=False, ordered=True):
+        """
+        Map ``func`` over ``iterable``, or if ``filtering`` is true, keep
+        the elements for which ``func`` returns a true value. Results are
+        yielded in the order of the elements if ``ordered`` is true,
+        otherwise chunk by chunk as they complete.
+        """
+        if filtering and func is None:
+            # like the builtin filter, keep the true elements
+            func = bool
+
+        sizer = ChunkSizer(
+            self.target_chunk_time, max_size=self.max_chunk_size
+        )
+        self.sizers.append(sizer)
+        pool = self._acquire_pool()
+        it = iter(iterable)
+        pending = {}
+        order = deque()
+
+        def submit():
+            chunk = list(islice(it, sizer.size))
+            if not chunk:
+                return False
+
+            packed = self._pack(chunk)
+            future = pool.submit(
+                _run_chunk, func, filtering, packed,
+                self.transport is not None
+            )
+            pending[future] = chunk, packed
+            if ordered:
+                order.append(future)
+
+            return True
+
+        def finish(future):
+            chunk, packed = pending.pop(future)
+            self._release(packed)
+            result, elapsed = future.result()
+            sizer.observe(len(chunk), elapsed)
+            if filtering:
+                return [chunk[i] for i in result]
+
+            return result
+
+        try:
+            for _ in range(2 * self.workers):
+                if not submit():
+                    break
+
+            while pending:
+                if ordered:
+                    done = [order.popleft()]
+                    wait(done)
+
+                else:
+                    done = wait(pending, return_when=FIRST_COMPLETED)[0]
+
+                for future in done:
+                    results = finish(future)
+                    submit()
+                    for result in results:
+                        yield result
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+            if self.transport is not None:
+                # running chunks may still be reading their segments
+                wait(pending)
+                for chunk, packed in pending.values():
+                    self._release(packed)
+
+            self._release_pool()
+
+    def sort(self, iterable, key=None, reverse=False):
+        """
+        Yield the elements of ``iterable`` in the order of the builtin
+        ``sorted(iterable, key=key, reverse=reverse)``. Chunks of the
+        input are sorted on the workers, one chunk per worker for sized
+        inputs, and the sorted runs are merged lazily in input order,
+        which keeps the sort stable. Chunks have at least
+        ``sort_chunk_size`` elements, so small inputs are sorted here
+        without starting the pool.
+        """
+        chunk_size = self.sort_chunk_size
+        if hasattr(iterable, '__len__'):
+            chunk_size = max(chunk_size, -(-len(iterable) // self.workers))
+
+        it = iter(iterable)
+        first = list(islice(it, chunk_size))
+        second = list(islice(it, chunk_size))
+        if not second:
+            for element in sorted(first, key=key, reverse=reverse):
+                yield element
+
+            return
+
+        pool = self._acquire_pool()
+        futures = []
+        try:
+            chunk = first
+            while chunk:
+                futures.append(
+                    pool.submit(_sort_chunk, chunk, key, reverse)
+                )
+                chunk, second = second, list(islice(it, chunk_size))
+
+            runs = [future.result() for future in futures]
+            futures = []
+
+        finally:
+            for future in futures:
+                future.cancel()
+
+            self._release_pool()
+
+        if key is None:
+            merged = merge(*runs, reverse=reverse)
+
+        else:
+            merged = merge(*runs, key=itemgetter(0), reverse=reverse)
+            merged = (element for _, element in merged)
+
+        del runs
+        for element in merged:
+            yield element
+
+    def stats(self):
+        """
+        Returns instrumentation for the stages run so far: for each stage,
+        the current chunk size, the estimated seconds per element and the
+        recent ``(chunk size, seconds)`` measurements.
+        """
+        return [
+            {
+                'chunk_size': sizer.size,
+                'cost_per_element': sizer.cost,
+                'chunks': list(sizer.history),
+            }
+            for sizer in self.sizers
+        ]
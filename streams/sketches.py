@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-memory summaries of streams.
+
+The sketches in this module can be fed one element at a time and
+merged with other sketches of the same kind, so partial results
+computed over separate partitions of the data can be combined.
+"""
+from __future__ import division
+from hashlib import sha1
+from math import ceil, exp, floor, log
+from random import Random
+from itertools import islice
+import struct
+
+_MASK64 = (1 << 64) - 1
+
+try:
+    text_type = unicode
+    integer_types = (int, long)
+except NameError:
+    text_type = str
+    integer_types = (int,)
+
+
+def _open_random(rng):
+    """
+    Return a random float from the open interval (0, 1).
+    """
+    r = rng.random()
+    while r == 0.0:
+        r = rng.random()
+
+    return r
+
+
+def reservoir_sample(iterable, k, seed=None):
+    """
+    Return a list of up to ``k`` elements chosen uniformly at random
+    from ``iterable``, using Li's Algorithm L. Only ``k`` elements are
+    held in memory, and the random number generator is consulted only
+    for the elements that end up in the reservoir, skipping over the
+    rest.
+    """
+    if k < 0:
+        raise ValueError("Sample size must be non-negative")
+
+    it = iter(iterable)
+    reservoir = list(islice(it, k))
+    if len(reservoir) < k or k == 0:
+        return reservoir
+
+    rng = Random(seed)
+    w = exp(log(_open_random(rng)) / k)
+    while True:
+        skip = int(floor(log(_open_random(rng)) / log(1 - w)))
+        for item in islice(it, skip, skip + 1):
+            reservoir[rng.randrange(k)] = item
+            break
+
+        else:
+            return reservoir
+
+        w *= exp(log(_open_random(rng)) / k)
+
+
+class QuantileSketch(object):
+    """
+    A KLL sketch for approximate quantiles of comparable elements.
+
+    The rank error of a quantile query is roughly ``accuracy`` of the
+    total number of elements, while the memory use depends only on
+    ``accuracy``, not on the number of elements added.
+    """
+
+    _decay = 2 / 3
+
+    def __init__(self, accuracy=0.01, seed=None):
+        if not 0 < accuracy < 1:
+            raise ValueError("accuracy must be between 0 and 1")
+
+        self.accuracy = accuracy
+        self._k = max(8, int(ceil(2 / accuracy)))
+        self._rng = Random(seed)
+        self._compactors = []
+        self._size = 0
+        self._max_size = 0
+        self.count = 0
+        self._grow()
+
+    def _capacity(self, height):
+        depth = len(self._compactors) - height - 1
+        return max(2, int(ceil(self._k * self._decay ** depth)))
+
+    def _grow(self):
+        self._compactors.append([])
+        self._max_size = sum(
+            self._capacity(h) for h in range(len(self._compactors))
+        )
+
+    def _compact_level(self, height):
+        items = self._compactors[height]
+        items.sort()
+        leftover = [items.pop()] if len(items) % 2 else []
+        offset = 1 if self._rng.random() < 0.5 else 0
+        if height + 1 >= len(self._compactors):
+            self._grow()
+
+        self._compactors[height + 1].extend(items[offset::2])
+        self._compactors[height] = leftover
+
+    def _compress(self):
+        for height in range(len(self._compactors)):
+            if len(self._compactors[height]) >= self._capacity(height):
+                self._compact_level(height)
+                self._size = sum(len(c) for c in self._compactors)
+                if self._size < self._max_size:
+                    break
+
+    def update(self, value):
+        """
+        Add a single value to the sketch.
+        """
+        self._compactors[0].append(value)
+        self._size += 1
+        self.count += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def update_all(self, iterable):
+        """
+        Add all values from ``iterable`` to the sketch.
+        """
+        for value in iterable:
+            self.update(value)
+
+        return self
+
+    def merge(self, other):
+        """
+        Merge the contents of ``other`` into this sketch, as if all
+        elements added to ``other`` had been added to this one.
+        """
+        while len(self._compactors) < len(other._compactors):
+            self._compactors.append([])
+
+        for height, items in enumerate(other._compactors):
+            self._compactors[height].extend(items)
+
+        self._max_size = sum(
+            self._capacity(h) for h in range(len(self._compactors))
+        )
+        self.count += other.count
+        self._size = sum(len(c) for c in self._compactors)
+        while self._size >= self._max_size:
+            self._compress()
+
+        return self
+
+    def quantiles(self, qs):
+        """
+        Return the approximate values at the given quantiles; each
+        quantile must be in the range ``[0, 1]``.
+        """
+        if not self.count:
+            raise ValueError("quantiles of an empty sketch")
+
+        weighted = sorted(
+            (value, 1 << height)
+            for height, items in enumerate(self._compactors)
+            for value in items
+        )
+        total = sum(weight for _, weight in weighted)
+
+        result = []
+        for q in qs:
+            if not 0 <= q <= 1:
+                raise ValueError("quantiles must be between 0 and 1")
+
+            target = q * total
+            cumulative = 0
+            for value, weight in weighted:
+                cumulative += weight
+                if cumulative >= target:
+                    break
+
+            result.append(value)
+
+        return result
+
+    def quantile(self, q):
+        """
+        Return the approximate value at the quantile ``q``.
+        """
+        return self.quantiles([q])[0]
+
+
+def _hash64(value):
+    """
+    Hash ``value`` into 64 bits, so that equal values get equal hashes.
+    Strings, bytes, integers and floats are hashed by their contents,
+    giving the same result in every process, and integral floats the
+    same as the equal integers; other values are hashed with the builtin
+    ``hash``, which for most types changes from one process to another.
+    """
+    if isinstance(value, bytes):
+        data = value
+    elif isinstance(value, text_type):
+        data = value.encode('utf-8')
+    elif isinstance(value, float) and not value.is_integer():
+        data = b'\0float:' + struct.pack('>d', value)
+    elif isinstance(value, integer_types + (float,)):
+        # the builtin hash of integers is their value modulo 2 ** 61 - 1,
+        # with hash(-1) == hash(-2)
+        data = b'\0int:' + ('%x' % int(value)).encode('ascii')
+    else:
+        # the splitmix64 finalizer spreads the bits of the hash
+        x = hash(value) & _MASK64
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return x ^ (x >> 31)
+
+    return struct.unpack('>Q', sha1(data).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog sketch for approximate distinct counts.
+
+    The sketch uses ``2 ** precision`` one-byte registers; the relative
+    standard error of the estimate is about ``1.04 / sqrt(2 ** precision)``.
+    Equal elements are counted once, as by ``distinct``. Sketches built
+    in different processes can be merged if their elements are strings,
+    bytes, integers or floats.
+    """
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+
+        self.precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def update(self, value):
+        """
+        Add a single value to the sketch.
+        """
+        x = _hash64(value)
+        rest_bits = 64 - self.precision
+        index = x >> rest_bits
+        rank = rest_bits - (x & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def update_all(self, iterable):
+        """
+        Add all values from ``iterable`` to the sketch.
+        """
+        for value in iterable:
+            self.update(value)
+
+        return self
+
+    def merge(self, other):
+        """
+        Merge the contents of ``other`` into this sketch. Both sketches
+        must have the same precision.
+        """
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches of different precision")
+
+        self._registers = bytearray(
+            max(a, b) for a, b in zip(self._registers, other._registers)
+        )
+        return self
+
+    def estimate(self):
+        """
+        Return the estimated number of distinct values added.
+        """
+        m = len(self._registers)
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(m / zeros)
+
+        return int(round(estimate))
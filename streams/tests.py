@@ -5,6 +5,31 @@ import operator
 from itertools import islice, cycle, starmap
 from functools import partial
 from streams import Stream
+from streams import transport
+
+
+def _sum_packed(packed):
+    with packed as view:
+        return sum(view)
+
+
+def _square(x):
+    return x * x
+
+
+def _is_odd(x):
+    return x % 2 == 1
+
+
+def _exit_once(x):
+    # kills the first worker process that sees 7
+    import os
+    marker = os.environ['STREAMS_TEST_MARKER']
+    if x == 7 and not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+
+    return x
 
 
 class UnitTests(TestCase):
@@ -192,6 +217,22 @@ class UnitTests(TestCase):
             [sentinel] * 10
         )
 
+        class Vector(object):
+            def __init__(self, x):
+                self.x = x
+
+            def __eq__(self, other):
+                if not isinstance(other, Vector):
+                    raise TypeError("cannot compare with %r" % other)
+
+                return self.x == other.x
+
+        # elements are never compared with anything
+        self.assertEqual(
+            Stream.generate(lambda: Vector(1)).limit(2).count(),
+            2
+        )
+
     def test_getitem(self):
         """
         Streams support slicing, but not indexing.
@@ -363,3 +404,944 @@ class UnitTests(TestCase):
         s_false, s_true = Stream(range(10)).partition(lambda x: x % 2 == 0)
         self.assertListEqual(list(s_true), [0, 2, 4, 6, 8])
         self.assertListEqual(list(s_false), [1, 3, 5, 7, 9])
+
+    def test_sample(self):
+        """
+        Stream.sample returns up to k elements of the stream chosen by
+        reservoir sampling, reproducibly for a given seed.
+        """
+        self.assertListEqual(Stream(range(3)).sample(5), [0, 1, 2])
+        self.assertListEqual(Stream(range(3)).sample(0), [])
+
+        s = Stream(range(10000)).sample(10, seed=42)
+        self.assertEqual(len(s), 10)
+        self.assertEqual(len(set(s)), 10)
+        self.assertTrue(all(0 <= x < 10000 for x in s))
+        self.assertListEqual(s, Stream(range(10000)).sample(10, seed=42))
+
+    def test_quantiles(self):
+        """
+        Stream.quantiles returns approximate quantiles within the
+        requested rank accuracy.
+        """
+        data = list(range(10000))
+        data = data[::2] + data[1::2]
+        lo, median, p99 = Stream(data).quantiles([0, 0.5, 0.99])
+        self.assertLessEqual(abs(median - 5000), 200)
+        self.assertLessEqual(abs(p99 - 9900), 200)
+        self.assertLessEqual(lo, 200)
+
+        self.assertListEqual(Stream([3, 1, 2]).quantiles([0.5]), [2])
+        self.assertRaises(ValueError, Stream([]).quantiles, [0.5])
+
+    def test_quantile_sketch_merge(self):
+        """
+        Quantile sketches built over separate partitions merge into one.
+        """
+        from streams.sketches import QuantileSketch
+        a = QuantileSketch(seed=1).update_all(range(0, 20000, 2))
+        b = QuantileSketch(seed=2).update_all(range(1, 20000, 2))
+        merged = a.merge(b)
+        self.assertEqual(merged.count, 20000)
+        self.assertLessEqual(abs(merged.quantile(0.5) - 10000), 400)
+
+    def test_approx_count_distinct(self):
+        """
+        Stream.approx_count_distinct estimates the number of distinct
+        elements, and HyperLogLog sketches merge.
+        """
+        from streams.sketches import HyperLogLog
+        self.assertEqual(Stream('abcabc').approx_count_distinct(), 3)
+
+        estimate = Stream(range(20000)).approx_count_distinct()
+        self.assertLessEqual(abs(estimate - 20000), 20000 * 0.05)
+
+        a = HyperLogLog().update_all(range(0, 15000))
+        b = HyperLogLog().update_all(range(5000, 20000))
+        estimate = a.merge(b).estimate()
+        self.assertLessEqual(abs(estimate - 20000), 20000 * 0.05)
+
+        self.assertRaises(ValueError, a.merge, HyperLogLog(10))
+
+        class Key(object):
+            def __init__(self, value):
+                self.value = value
+
+            def __eq__(self, other):
+                return self.value == other.value
+
+            def __hash__(self):
+                return hash(self.value)
+
+        keys = Stream(range(1000)).map(lambda i: Key(i % 10))
+        self.assertEqual(keys.approx_count_distinct(), 10)
+        self.assertEqual(Stream([1, 1.0, True]).approx_count_distinct(), 1)
+        self.assertEqual(Stream([-1, -2]).approx_count_distinct(), 2)
+        self.assertEqual(
+            Stream([0, 2 ** 61 - 1, 2 * (2 ** 61 - 1)])
+            .approx_count_distinct(),
+            3
+        )
+
+    def test_prefetch(self):
+        """
+        Stream.prefetch yields the same elements in the same order, and
+        passes exceptions through to the consumer.
+        """
+        self.assertListEqual(
+            Stream(range(100)).prefetch(3).map(lambda x: x * 2).to_list(),
+            list(range(0, 200, 2))
+        )
+        self.assertListEqual(Stream([]).prefetch(1).to_list(), [])
+
+        def failing():
+            yield 1
+            raise KeyError('boom')
+
+        s = Stream(failing()).prefetch(2)
+        self.assertEqual(next(s), 1)
+        self.assertRaises(KeyError, next, s)
+
+        self.assertRaises(ValueError, Stream([]).prefetch, 0)
+
+    def test_prefetch_early_stop(self):
+        """
+        The prefetching thread stops when the consumer stops early.
+        """
+        import threading
+        import time
+        from itertools import count
+
+        produced = []
+        s = Stream(count()).peek(produced.append).prefetch(2)
+        self.assertListEqual(s.limit(3).to_list(), [0, 1, 2])
+        del s
+
+        deadline = time.time() + 5
+        while time.time() < deadline and any(
+            t.name == 'streams-prefetch' for t in threading.enumerate()
+        ):
+            time.sleep(0.01)
+
+        self.assertFalse(any(
+            t.name == 'streams-prefetch' for t in threading.enumerate()
+        ))
+        self.assertLessEqual(len(produced), 10)
+
+    def test_transport(self):
+        """
+        Transport passes large buffers through shared memory, recycles
+        the segments, and counts shared and copied bytes.
+        """
+        import pickle
+        from array import array
+        from multiprocessing import Pool
+
+        if transport.SharedMemory is None:
+            self.skipTest("shared memory is not available")
+
+        with transport.Transport() as t:
+            data = array('d', range(100000))
+            packed = t.pack(data)
+            self.assertIsInstance(packed, transport.SharedChunk)
+            self.assertLess(len(pickle.dumps(packed)), 200)
+            with pickle.loads(pickle.dumps(packed)) as view:
+                self.assertEqual(view.format, 'd')
+                self.assertEqual(list(view[:3]), [0.0, 1.0, 2.0])
+                self.assertEqual(len(view), 100000)
+
+            t.release(packed)
+            packed = t.pack(bytes(bytearray(range(256)) * 3125))
+            with pickle.loads(pickle.dumps(packed)) as view:
+                self.assertEqual(bytes(view[:3]), b'\x00\x01\x02')
+
+            pool = Pool(1)
+            try:
+                self.assertEqual(
+                    pool.apply(_sum_packed, (packed,)),
+                    sum(range(256)) * 3125
+                )
+            finally:
+                pool.terminate()
+                pool.join()
+
+            t.release(packed)
+            small = t.pack(b'abc')
+            self.assertIsInstance(small, transport.InlineChunk)
+            with small as value:
+                self.assertEqual(value, b'abc')
+
+            stats = t.stats()
+            self.assertEqual(stats['bytes_shared'], 1600000)
+            self.assertEqual(stats['bytes_copied'], 3)
+            self.assertEqual(stats['segments_created'], 1)
+            self.assertEqual(stats['segments_reused'], 1)
+
+    def test_map_concurrent(self):
+        """
+        Stream.map_concurrent maps on a thread pool, in order or as the
+        results complete, keeping a bounded number of calls in flight.
+        """
+        import threading
+        import time
+
+        self.assertListEqual(
+            Stream(range(50)).map_concurrent(lambda x: x * 2, workers=4)
+            .to_list(),
+            list(range(0, 100, 2))
+        )
+
+        def slow_first(x):
+            time.sleep(0.2 if x == 0 else 0)
+            return x
+
+        unordered = Stream(range(10)).map_concurrent(
+            slow_first, workers=4, ordered=False
+        ).to_list()
+        self.assertEqual(sorted(unordered), list(range(10)))
+        self.assertNotEqual(unordered[0], 0)
+
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def track(x):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+            return x
+
+        Stream(range(20)).map_concurrent(
+            track, workers=8, max_in_flight=3
+        ).to_list()
+        self.assertLessEqual(running[1], 3)
+
+        def fail(x):
+            raise KeyError(x)
+
+        s = Stream(range(5)).map_concurrent(fail, workers=2)
+        self.assertRaises(KeyError, s.to_list)
+
+    def test_map_concurrent_early_stop(self):
+        """
+        Stream.map_concurrent takes only a bounded number of elements
+        ahead, and stops when the consumer does.
+        """
+        from itertools import count
+
+        consumed = []
+        s = Stream(count()).peek(consumed.append)
+        self.assertListEqual(
+            s.map_concurrent(lambda x: x, workers=2, max_in_flight=4)
+            .limit(5).to_list(),
+            list(range(5))
+        )
+        self.assertLessEqual(len(consumed), 9)
+
+    def test_to_columns(self):
+        """
+        Stream.to_columns packs records into array-backed column batches
+        that support projection, filtering, reductions and conversion
+        back to rows.
+        """
+        from array import array
+        rows = [{'x': i, 'y': i / 2, 'name': str(i)} for i in range(10)]
+        schema = [('x', 'l'), ('y', 'd'), ('name', None)]
+
+        batches = Stream(rows).to_columns(schema, batch_size=4).batches() \
+            .to_list()
+        self.assertListEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertIsInstance(batches[0]['x'], array)
+        self.assertIsInstance(batches[0]['name'], list)
+
+        columns = lambda: Stream(rows).to_columns(schema, batch_size=4)
+        self.assertListEqual(columns().to_rows().to_list(), rows)
+        self.assertEqual(columns().count(), 10)
+        self.assertEqual(columns().sum('x'), 45)
+        self.assertEqual(columns().average('y'), 2.25)
+        self.assertEqual(columns().min('name'), '0')
+        self.assertEqual(columns().max('x'), 9)
+        self.assertListEqual(columns().column('x').to_list(), list(range(10)))
+
+        evens = columns().where('x', lambda x: x % 2 == 0)
+        self.assertListEqual(
+            evens.select('name', 'x').to_rows(tuples=True).to_list(),
+            [(str(i), i) for i in range(0, 10, 2)]
+        )
+        self.assertEqual(columns().where('x', lambda x: x > 100).count(), 0)
+
+        tuples = [(i, i * i) for i in range(5)]
+        self.assertListEqual(
+            Stream(tuples).to_columns([('a', 'i'), ('b', 'i')])
+            .to_rows(tuples=True).to_list(),
+            tuples
+        )
+        self.assertRaises(ValueError, Stream([]).to_columns, [('a', 'Z')])
+
+    def test_characteristics(self):
+        """
+        Streams track the ORDERED, DISTINCT, SORTED and SIZED
+        characteristics through their operators.
+        """
+        from streams import ORDERED, DISTINCT, SORTED, SIZED
+
+        self.assertEqual(
+            Stream([3, 1, 2]).characteristics, ORDERED | SIZED
+        )
+        self.assertEqual(
+            Stream(range(5)).characteristics,
+            ORDERED | DISTINCT | SORTED | SIZED
+        )
+        self.assertEqual(Stream(set([1, 2])).characteristics, DISTINCT | SIZED)
+        self.assertEqual(Stream(iter([1])).characteristics, ORDERED)
+
+        s = Stream(range(10)).filter(lambda x: x % 2)
+        self.assertTrue(s.has_characteristics(ORDERED | DISTINCT | SORTED))
+        self.assertFalse(s.has_characteristics(SIZED))
+        self.assertFalse(
+            Stream(range(10)).map(lambda x: -x).has_characteristics(SORTED)
+        )
+
+        s = Stream([3, 1, 2]).sorted()
+        self.assertEqual(s.characteristics, ORDERED | SORTED | SIZED)
+        self.assertIs(s.sorted(), s)
+        self.assertFalse(
+            Stream([3, 1]).sorted(reverse=True).has_characteristics(SORTED)
+        )
+        self.assertFalse(Stream([1]).unordered().has_characteristics(ORDERED))
+        self.assertTrue(
+            Stream([1, 1]).distinct().has_characteristics(DISTINCT)
+        )
+
+    def test_characteristics_shortcuts(self):
+        """
+        Operators skip redundant work based on the characteristics.
+        """
+        s = Stream(range(10))
+        self.assertIs(s.distinct(), s)
+        self.assertEqual(Stream(range(10)).count(), 10)
+        self.assertEqual(Stream(range(5, 10)).min(), 5)
+        self.assertEqual(Stream(range(5, 10)).max(), 9)
+        self.assertRaises(ValueError, Stream(range(0)).min)
+
+        # the length of a sized source is not asked for up front
+        from streams import SIZED, SORTED
+        huge = Stream(range(10 ** 20))
+        self.assertTrue(huge.has_characteristics(SIZED | SORTED))
+        self.assertListEqual(huge.limit(3).to_list(), [0, 1, 2])
+
+        class Lazy(object):
+            def __len__(self):
+                raise AssertionError("len() called")
+
+            def __iter__(self):
+                return iter([2, 1])
+
+        self.assertEqual(Stream(Lazy()).map(_square).sum(), 5)
+        self.assertRaises(ValueError, Stream(iter(range(0))).sorted().max)
+        self.assertIs(type(Stream.merge_sorted([1, 1.0]).max()), int)
+
+        # distinct on sorted input compares neighbours only
+        sorted_dupes = Stream([3, 1, 2, 1, 3, 3]).sorted()
+        self.assertListEqual(sorted_dupes.distinct().to_list(), [1, 2, 3])
+
+        self.assertListEqual(
+            Stream.merge_sorted([1, 4, 7], [2, 5], [3, 6])
+            .sorted().to_list(),
+            list(range(1, 8))
+        )
+        self.assertListEqual(
+            Stream.merge_sorted([1, 2, 2], [2, 3]).distinct().to_list(),
+            [1, 2, 3]
+        )
+
+    def test_parallel(self):
+        """
+        Stream.parallel runs map and filter on worker processes in
+        adaptively sized chunks, keeping the order of ordered streams.
+        """
+        from streams.parallel import ParallelExecutor
+        executor = ParallelExecutor(workers=2, target_chunk_time=0.01)
+
+        self.assertListEqual(
+            Stream(range(5000)).parallel(executor=executor)
+            .map(_square).filter(_is_odd).to_list(),
+            [x * x for x in range(5000) if x % 2]
+        )
+
+        stats = executor.stats()
+        self.assertEqual(len(stats), 2)
+        sizes = [n for n, _ in stats[0]['chunks']]
+        self.assertEqual(sizes[0], 1)
+        self.assertGreater(max(sizes), 1)
+        self.assertGreater(stats[0]['chunk_size'], 1)
+
+        self.assertEqual(
+            sorted(Stream(range(100)).unordered().parallel(workers=2)
+                   .map(_square).to_list()),
+            [x * x for x in range(100)]
+        )
+
+        self.assertListEqual(
+            Stream([0, 1, '', 'a']).parallel(executor=executor)
+            .filter(None).to_list(),
+            [1, 'a']
+        )
+
+        # lambdas cannot be pickled and run sequentially
+        self.assertListEqual(
+            Stream(range(10)).parallel(workers=2).map(lambda x: -x)
+            .to_list(),
+            [-x for x in range(10)]
+        )
+        self.assertListEqual(
+            Stream(range(10)).parallel().sequential().map(_square).to_list(),
+            [x * x for x in range(10)]
+        )
+
+    def test_chunk_sizer(self):
+        """
+        ChunkSizer grows chunks for cheap elements and shrinks them for
+        expensive ones, towards the target time per chunk.
+        """
+        from streams.parallel import ChunkSizer
+        sizer = ChunkSizer(target_chunk_time=0.1)
+        for _ in range(20):
+            sizer.observe(sizer.size, sizer.size * 1e-6)
+
+        self.assertEqual(sizer.size, 100000)
+
+        sizer = ChunkSizer(target_chunk_time=0.1, initial_size=1000)
+        sizer.observe(1000, 100.0)
+        self.assertEqual(sizer.size, 1)
+
+    def test_parallel_transport(self):
+        """
+        A parallel executor with a transport sends large buffers through
+        shared memory.
+        """
+        from streams.parallel import ParallelExecutor
+
+        if transport.SharedMemory is None:
+            self.skipTest("shared memory is not available")
+
+        blobs = [bytes(bytearray([i]) * 100000) for i in range(5)]
+        with transport.Transport() as t:
+            executor = ParallelExecutor(workers=1, transport=t)
+            self.assertListEqual(
+                Stream(blobs).parallel(executor=executor).map(sum).to_list(),
+                [i * 100000 for i in range(5)]
+            )
+            self.assertEqual(t.bytes_shared, 500000)
+
+    def test_memory_budget(self):
+        """
+        Under a memory budget, sorted spills runs to disk, partition
+        spills its buffer and distinct degrades to a Bloom filter, and
+        the peak usage of each operator is reported.
+        """
+        from streams.memory import MemoryBudget
+
+        data = [(i * 7919) % 1000 for i in range(3000)]
+        s = Stream(data, memory_budget=2000)
+        self.assertListEqual(s.sorted().to_list(), sorted(data))
+        self.assertLessEqual(s.memory_budget.report()['sorted'], 2000)
+        self.assertEqual(s.memory_budget.used, 0)
+
+        pairs = [(i % 10, i) for i in range(500)]
+        key = operator.itemgetter(0)
+        self.assertListEqual(
+            Stream(pairs, memory_budget=1000).sorted(
+                key=key, reverse=True
+            ).to_list(),
+            sorted(pairs, key=key, reverse=True)
+        )
+
+        budget = MemoryBudget(4000)
+        s_false, s_true = Stream(range(1000), memory_budget=budget) \
+            .map(lambda x: x).partition(lambda x: x % 2 == 0)
+        self.assertListEqual(list(s_true), list(range(0, 1000, 2)))
+        self.assertListEqual(list(s_false), list(range(1, 1000, 2)))
+        self.assertLessEqual(budget.report()['partition'], 4000)
+        self.assertEqual(budget.used, 0)
+
+        # nothing is buffered for a side that has been dropped
+        budget = MemoryBudget(10 ** 6)
+        s_true = Stream(range(10000), memory_budget=budget) \
+            .map(lambda x: x).partition(lambda x: x % 2 == 0)[1]
+        self.assertEqual(len(s_true.to_list()), 5000)
+        self.assertEqual(budget.used, 0)
+
+        distinct = Stream(iter(data), memory_budget=budget).distinct() \
+            .to_list()
+        self.assertLessEqual(len(distinct), 1000)
+        self.assertGreater(len(distinct), 900)
+        self.assertEqual(len(set(distinct)), len(distinct))
+        self.assertIn('distinct', budget.report())
+
+
+        # with a shared budget used up by another operator, distinct
+        # still keeps nearly all elements, and sorted spills runs of a
+        # reasonable length
+        budget = MemoryBudget(1000)
+        budget.account('other').reserve(1000)
+        self.assertGreaterEqual(
+            Stream(range(5000), memory_budget=budget).map(_square)
+            .distinct().count(),
+            4950
+        )
+        self.assertListEqual(
+            Stream(data + data, memory_budget=budget).sorted().to_list(),
+            sorted(data + data)
+        )
+
+        # runs are merged when too many are spilled
+        from streams import memory
+        self.addCleanup(setattr, memory, '_MIN_RUN', memory._MIN_RUN)
+        self.addCleanup(setattr, memory, '_MAX_RUNS', memory._MAX_RUNS)
+        memory._MIN_RUN = 10
+        memory._MAX_RUNS = 4
+        self.assertListEqual(
+            Stream(pairs, memory_budget=budget).sorted(key=key).to_list(),
+            sorted(pairs, key=key)
+        )
+
+        self.assertRaises(TypeError, Stream, [], budget=1)
+
+    def test_parallel_sorted(self):
+        """
+        Stream.sorted on a parallel stream sorts chunks on the workers and
+        gives the same result as the builtin sorted, including stability
+        and reverse.
+        """
+        from streams.parallel import ParallelExecutor
+        executor = ParallelExecutor(workers=2, sort_chunk_size=100)
+
+        data = [(i * 7919) % 101 for i in range(1000)]
+        self.assertListEqual(
+            Stream(data).parallel(executor=executor).sorted().to_list(),
+            sorted(data)
+        )
+        self.assertListEqual(
+            Stream(iter(data)).parallel(executor=executor)
+            .sorted(reverse=True).to_list(),
+            sorted(data, reverse=True)
+        )
+
+        pairs = [(i % 7, i) for i in range(1000)]
+        key = operator.itemgetter(0)
+        for reverse in (False, True):
+            self.assertListEqual(
+                Stream(iter(pairs)).parallel(executor=executor)
+                .sorted(key=key, reverse=reverse).to_list(),
+                sorted(pairs, key=key, reverse=reverse)
+            )
+
+        # small inputs are sorted without starting the pool
+        executor = ParallelExecutor(workers=2)
+        executor._acquire_pool = None
+        self.assertListEqual(
+            Stream([3, 1, 2]).parallel(executor=executor).sorted().to_list(),
+            [1, 2, 3]
+        )
+
+    def test_checkpoint_resume(self):
+        """
+        A checkpointed stream that fails can be resumed from the last
+        checkpoint, restoring the source position, the distinct state
+        and the terminal accumulator.
+        """
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = os.path.join(directory, 'job.checkpoint')
+        data = [i % 50 for i in range(100)] + list(range(100, 150))
+        seen = []
+
+        def job(fail_at=None):
+            def process(x):
+                if len(seen) == fail_at:
+                    raise KeyError(x)
+
+                seen.append(x)
+                return x
+
+            return Stream.resume(store, data).map(process).distinct() \
+                .checkpoint(every=7).sum()
+
+        self.assertRaises(KeyError, job, 120)
+        self.assertEqual(len(seen), 120)
+
+        del seen[:]
+        self.assertEqual(job(), sum(set(data)))
+        self.assertLess(len(seen), 40)
+
+        # a completed job clears its checkpoint, and the next job
+        # starts from the beginning
+        self.assertFalse(os.path.exists(store))
+        del seen[:]
+        self.assertEqual(job(), sum(set(data)))
+        self.assertEqual(len(seen), len(data))
+        self.assertEqual(
+            Stream.resume(store, list(range(10))).checkpoint(every=100)
+            .sum(),
+            45
+        )
+
+    def test_checkpoint_other_sources(self):
+        """
+        Sources that are not lists, tuples, ranges or files are resumed
+        by skipping the elements before the saved position.
+        """
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def job(store, fail_at, *iterables):
+            def process(x):
+                if isinstance(x, tuple):
+                    x = sum(x)
+
+                if x == fail_at:
+                    raise KeyError(x)
+
+                return x
+
+            return Stream.resume(store, *iterables).map(process) \
+                .checkpoint(every=3).sum()
+
+        store = os.path.join(directory, 'chain.checkpoint')
+        self.assertRaises(KeyError, job, store, 7, range(5), range(5, 10))
+        self.assertEqual(job(store, None, range(5), range(5, 10)), 45)
+
+        store = os.path.join(directory, 'zip.checkpoint')
+        self.assertRaises(KeyError, job, store, 14, zip(range(10), range(10)))
+        self.assertEqual(job(store, None, zip(range(10), range(10))), 90)
+
+    def test_checkpoint_file_source(self):
+        """
+        File sources are resumed by seeking to the saved offset.
+        """
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = os.path.join(directory, 'job.checkpoint')
+        path = os.path.join(directory, 'input.txt')
+        with open(path, 'wb') as f:
+            f.write(b''.join(b'%d\n' % i for i in range(100)))
+
+        parsed = []
+
+        def job(fail_at=None):
+            def parse(line):
+                if int(line) == fail_at:
+                    raise KeyError(line)
+
+                parsed.append(int(line))
+                return int(line)
+
+            with open(path, 'rb') as f:
+                return Stream.resume(store, f).map(parse) \
+                    .checkpoint(every=10).average()
+
+        self.assertRaises(KeyError, job, 25)
+        del parsed[:]
+        self.assertEqual(job(), sum(range(100)) / 100)
+        self.assertEqual(parsed[0], 20)
+
+        self.assertRaises(
+            ValueError,
+            lambda: Stream.resume(store, []).sorted().checkpoint(every=1)
+        )
+        self.assertRaises(ValueError, lambda: Stream([]).checkpoint(every=1))
+        self.assertRaises(
+            ValueError,
+            Stream.resume(store, []).checkpoint(every=1).to_list
+        )
+        self.assertRaises(
+            ValueError, Stream.resume(store, []).checkpoint(every=1).max
+        )
+
+    def test_stream_without_getrefcount(self):
+        """
+        Streams work when sys.getrefcount is missing, as on PyPy; every
+        stage then gets a new stream.
+        """
+        import streams
+        saved = streams._getrefcount, streams._UNSHARED_REFCOUNT
+        self.addCleanup(setattr, streams, '_getrefcount', saved[0])
+        self.addCleanup(setattr, streams, '_UNSHARED_REFCOUNT', saved[1])
+        streams._getrefcount = None
+        streams._UNSHARED_REFCOUNT = streams._calibrate_unshared_refcount()
+
+        self.assertEqual(streams._UNSHARED_REFCOUNT, -1)
+        self.assertListEqual(
+            Stream(range(5)).filter(_is_odd).map(_square).to_list(), [1, 9]
+        )
+
+    def test_stream_reuse(self):
+        """
+        Streams have no instance dictionary, and a stream that is referred
+        to from elsewhere is never modified by adding a stage to it.
+        """
+        from streams import SIZED
+        self.assertFalse(hasattr(Stream([]), '__dict__'))
+
+        s = Stream([1, 2, 3])
+        t = s.map(operator.neg)
+        self.assertIsNot(t, s)
+        self.assertTrue(s.has_characteristics(SIZED))
+        self.assertListEqual(s.to_list(), [1, 2, 3])
+        self.assertListEqual(t.to_list(), [-1, -2, -3])
+
+        self.assertListEqual(
+            Stream.of(1, 2, 3, 4).filter(_is_odd).map(_square)
+            .peek(lambda x: None).distinct().to_list(),
+            [1, 9]
+        )
+
+        # map with several iterables on a stream with pipeline settings
+        self.assertListEqual(
+            Stream([1, 2], memory_budget=10 ** 6)
+            .map(operator.add, [10, 20]).to_list(),
+            [11, 22]
+        )
+        self.assertListEqual(
+            Stream([1, 2]).parallel(workers=1)
+            .map(operator.add, [10, 20]).to_list(),
+            [11, 22]
+        )
+
+        # small sources are deduplicated without a generator
+        self.assertListEqual(
+            Stream([3, 1, 3, 2, 1]).distinct().to_list(), [3, 1, 2]
+        )
+        self.assertListEqual(
+            Stream(list(range(100)) * 2).distinct().to_list(),
+            list(range(100))
+        )
+
+    def test_distributed(self):
+        """
+        Distributed terminal operations give the same results as local
+        ones, for sequence and file sources, and the partitions of a
+        failed worker are rescheduled.
+        """
+        import os
+        import shutil
+        import tempfile
+        from streams.distributed import Cluster, LocalCluster
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'input.txt')
+        with open(path, 'wb') as f:
+            f.write(b''.join(b'%d\n' % i for i in range(1000)))
+
+        marker = os.path.join(directory, 'marker')
+        os.environ['STREAMS_TEST_MARKER'] = marker
+        self.addCleanup(os.environ.pop, 'STREAMS_TEST_MARKER')
+
+        data = list(range(100))
+        with LocalCluster(2) as cluster:
+            def stream():
+                return Stream(data).distributed(cluster) \
+                    .filter(_is_odd).map(_square)
+
+            expected = [x * x for x in data if x % 2]
+            self.assertEqual(stream().count(), 50)
+            self.assertEqual(stream().sum(), sum(expected))
+            self.assertListEqual(stream().to_list(), expected)
+            self.assertListEqual(
+                stream().top_k(3, key=operator.neg), expected[:3]
+            )
+            self.assertDictEqual(
+                stream().map(str).group_by(len),
+                Stream(expected).map(str).group_by(len)
+            )
+            self.assertListEqual(
+                stream().collect(list, list.append, list.extend), expected
+            )
+            self.assertListEqual(
+                Stream([(7, 2), (9, 4)]).distributed(cluster)
+                .starmap(divmod).to_list(),
+                [(3, 1), (2, 1)]
+            )
+
+            with open(path) as f:
+                self.assertEqual(
+                    Stream(f).distributed(cluster, partitions=7)
+                    .map(int).sum(),
+                    sum(range(1000))
+                )
+
+            # streams derived from the same distributed stream keep
+            # their own stages
+            source = Stream(list(range(10))).distributed(cluster)
+            negated = source.map(operator.neg)
+            squares = source.map(_square)
+            self.assertListEqual(negated.to_list(), [-x for x in range(10)])
+            self.assertEqual(squares.sum(), sum(x * x for x in range(10)))
+            source = Stream(list(range(10))).distributed(cluster)
+            source.filter(_is_odd)
+            self.assertEqual(
+                source.map(_square).sum(), sum(x * x for x in range(10))
+            )
+
+            # lambdas run locally
+            self.assertEqual(
+                stream().map(lambda x: -x).sum(), -sum(expected)
+            )
+
+            self.assertRaises(
+                ZeroDivisionError,
+                Stream([1, 0]).distributed(cluster).map(
+                    partial(operator.truediv, 1)
+                ).to_list
+            )
+
+            # a task that the workers cannot unpickle fails with the
+            # error raised on the worker
+            import sys
+            import types
+            module = types.ModuleType('streams_client_only')
+            exec('def negate(x):\n    return -x\n', module.__dict__)
+            sys.modules[module.__name__] = module
+            self.addCleanup(sys.modules.pop, module.__name__)
+            self.assertRaises(
+                ImportError,
+                Stream(data).distributed(cluster).map(module.negate).sum
+            )
+            self.assertEqual(cluster.failures, [])
+
+            self.assertListEqual(
+                Stream(data).distributed(cluster).map(_exit_once).to_list(),
+                data
+            )
+            self.assertTrue(os.path.exists(marker))
+            self.assertEqual(len(cluster.failures), 1)
+
+            unreachable = Cluster(
+                [('127.0.0.1', 1)] + cluster.addresses, cluster.authkey
+            )
+            self.assertEqual(
+                Stream(data).distributed(unreachable).map(_square).sum(),
+                sum(x * x for x in data)
+            )
+
+        self.assertRaises(
+            ValueError, Stream(iter(data)).distributed, unreachable
+        )
+        import gzip
+        with gzip.open(os.path.join(directory, 'input.gz'), 'wb') as f:
+            self.assertRaises(
+                ValueError, Stream(f).distributed, unreachable
+            )
+
+    def test_from_compressed(self):
+        """
+        Compressed files are read as lines, with the codec detected from
+        their contents; the lines of many files are interleaved, keeping
+        the order within each file.
+        """
+        import bz2
+        import gzip
+        import lzma
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        openers = [gzip.open, bz2.open, lzma.open, open]
+        paths = []
+        for n, opener in enumerate(openers):
+            path = os.path.join(directory, 'log%d' % n)
+            with opener(path, 'wb') as f:
+                f.write(b''.join(
+                    b'%d %d %s\n' % (n, i, b'x' * (i % 50))
+                    for i in range(3000)
+                ))
+                f.write(b'%d last' % n)
+
+            paths.append(path)
+
+        for path, opener in zip(paths, openers):
+            with opener(path, 'rb') as f:
+                self.assertListEqual(
+                    Stream.from_compressed(path, block_size=1000).to_list(),
+                    list(f)
+                )
+
+        import pathlib
+        self.assertEqual(
+            len(Stream.from_compressed(pathlib.Path(paths[0])).to_list()),
+            3001
+        )
+
+        # concatenated gzip members are read to the end
+        with open(paths[0], 'rb') as f:
+            data = f.read()
+
+        with open(paths[0], 'ab') as f:
+            f.write(data)
+
+        lines = Stream.from_compressed(paths[0], codec='gz').to_list()
+        self.assertEqual(len(lines), 6001)
+        self.assertEqual(lines[3000], b'0 last0 0 \n')
+
+        lines = Stream.from_compressed(
+            paths[1:], threads=3, block_size=4096, encoding='ascii'
+        ).to_list()
+        self.assertEqual(len(lines), 3 * 3001)
+        for n in (1, 2, 3):
+            own = [line for line in lines if line.startswith('%d ' % n)]
+            self.assertEqual(own[0], '%d 0 \n' % n)
+            self.assertEqual(own[-1], '%d last' % n)
+            self.assertListEqual(
+                [int(line.split()[1]) for line in own[:-1]],
+                list(range(3000))
+            )
+
+        # the threads stop when the stream is closed early
+        import threading
+        import time
+        self.assertEqual(
+            len(Stream.from_compressed(paths, block_size=100)
+                .limit(5).to_list()),
+            5
+        )
+        for _ in range(100):
+            if not any(t.name == 'streams-decompress'
+                       for t in threading.enumerate()):
+                break
+
+            time.sleep(0.01)
+
+        else:
+            self.fail("decompression threads still running")
+
+        truncated = os.path.join(directory, 'truncated.xz')
+        with open(paths[2], 'rb') as f:
+            with open(truncated, 'wb') as out:
+                out.write(f.read()[:-100])
+
+        self.assertRaises(
+            EOFError, Stream.from_compressed(truncated).to_list
+        )
+        self.assertRaises(
+            ValueError, Stream.from_compressed, paths, codec='zip'
+        )
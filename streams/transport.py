@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Passing large contiguous chunks to worker processes without pickling.
+
+A :class:`Transport` copies a chunk that supports the buffer protocol
+(``bytes``, ``bytearray``, ``array.array`` or a C-contiguous numpy array)
+into a shared memory segment once, and hands out a small picklable
+handle instead. The worker opens the handle to get a view of the shared
+memory::
+
+    >>> transport = Transport()
+    >>> packed = transport.pack(array('d', range(100000)))
+    >>> # ... send ``packed`` to a worker, which does:
+    >>> with packed as view:
+    ...     total = sum(view)
+    >>> # ... and once the worker is done with it:
+    >>> transport.release(packed)
+
+Segments are recycled through a pool, so a long stream of chunks of
+similar size reuses a handful of segments. Chunks that are small or not
+contiguous buffers are passed through as is and pickled as usual.
+
+Shared memory requires :mod:`multiprocessing.shared_memory` (Python 3.8
+or later); on other versions every chunk is passed through unchanged.
+"""
+from array import array
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+
+_MIN_SEGMENT = 1 << 16
+
+
+def _segment_size(nbytes):
+    """
+    Round ``nbytes`` up to the pooled segment size.
+    """
+    size = _MIN_SEGMENT
+    while size < nbytes:
+        size <<= 1
+
+    return size
+
+
+class InlineChunk(object):
+    """
+    A chunk that travels to the worker by ordinary pickling.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class SharedChunk(object):
+    """
+    A picklable handle to a chunk stored in a shared memory segment.
+    Entering the handle attaches to the segment and returns a read-only
+    view of the chunk: a ``memoryview`` for bytes and arrays (cast to
+    the array's typecode), or a numpy array for numpy chunks.
+    """
+
+    def __init__(self, name, nbytes, kind, meta):
+        self.name = name
+        self.nbytes = nbytes
+        self.kind = kind
+        self.meta = meta
+        self._segment = None
+        self._views = []
+
+    def __getstate__(self):
+        return (self.name, self.nbytes, self.kind, self.meta)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __enter__(self):
+        self._segment = SharedMemory(self.name)
+        view = self._segment.buf[:self.nbytes]
+        self._views.append(view)
+        if self.kind == 'array':
+            view = view.cast(self.meta)
+            self._views.append(view)
+
+        elif self.kind == 'ndarray':
+            import numpy
+            dtype, shape = self.meta
+            result = numpy.ndarray(shape, dtype=dtype, buffer=view)
+            result.flags.writeable = False
+            return result
+
+        view = view.toreadonly()
+        self._views.append(view)
+        return view
+
+    def __exit__(self, *exc_info):
+        try:
+            for view in reversed(self._views):
+                view.release()
+
+            self._segment.close()
+
+        except BufferError:
+            # An array over the view outlived the with block; the
+            # mapping stays until it is garbage collected.
+            pass
+
+        del self._views[:]
+        self._segment = None
+        return False
+
+
+class Transport(object):
+    """
+    Packs chunks into pooled shared memory segments and keeps count of
+    the bytes that were shared versus passed by pickling.
+
+    Chunks smaller than ``min_size`` bytes are passed inline, since for
+    them the pickling overhead is smaller than the cost of a segment.
+    Up to ``max_idle`` released segments are kept for reuse.
+    """
+
+    def __init__(self, min_size=_MIN_SEGMENT, max_idle=8):
+        self.min_size = min_size
+        self.max_idle = max_idle
+        self.bytes_shared = 0
+        self.bytes_copied = 0
+        self.segments_created = 0
+        self.segments_reused = 0
+        self._idle = {}
+        self._idle_count = 0
+        self._in_use = {}
+
+    @staticmethod
+    def _describe(chunk):
+        """
+        Return ``(kind, meta, buffer)`` for chunks that can be shared,
+        or None for anything else.
+        """
+        if isinstance(chunk, (bytes, bytearray)):
+            return 'bytes', None, memoryview(chunk)
+
+        if isinstance(chunk, array):
+            return 'array', chunk.typecode, memoryview(chunk).cast('B')
+
+        if hasattr(chunk, '__array_interface__') and hasattr(chunk, 'flags'):
+            if chunk.flags['C_CONTIGUOUS'] and not chunk.dtype.hasobject:
+                meta = (chunk.dtype.str, chunk.shape)
+                return 'ndarray', meta, memoryview(chunk).cast('B')
+
+        return None
+
+    def pack(self, chunk):
+        """
+        Return a handle for ``chunk`` to send to a worker in its place;
+        the handle is a context manager that gives the worker the chunk
+        data.
+        """
+        description = None
+        if SharedMemory is not None:
+            description = self._describe(chunk)
+
+        if description is None or description[2].nbytes < self.min_size:
+            if description is not None:
+                self.bytes_copied += description[2].nbytes
+
+            return InlineChunk(chunk)
+
+        kind, meta, buf = description
+        segment = self._acquire(buf.nbytes)
+        segment.buf[:buf.nbytes] = buf
+        self._in_use[segment.name] = segment
+        self.bytes_shared += buf.nbytes
+        return SharedChunk(segment.name, buf.nbytes, kind, meta)
+
+    def _acquire(self, nbytes):
+        size = _segment_size(nbytes)
+        free = self._idle.get(size)
+        if free:
+            self._idle_count -= 1
+            self.segments_reused += 1
+            return free.pop()
+
+        self.segments_created += 1
+        return SharedMemory(create=True, size=size)
+
+    def release(self, packed):
+        """
+        Return the segment behind ``packed`` to the pool once the worker
+        no longer uses it. Inline chunks are ignored.
+        """
+        if not isinstance(packed, SharedChunk):
+            return
+
+        segment = self._in_use.pop(packed.name)
+        if self._idle_count < self.max_idle:
+            self._idle.setdefault(segment.size, []).append(segment)
+            self._idle_count += 1
+
+        else:
+            segment.close()
+            segment.unlink()
+
+    def stats(self):
+        """
+        Return the transport counters as a dictionary.
+        """
+        return {
+            'bytes_shared': self.bytes_shared,
+            'bytes_copied': self.bytes_copied,
+            'segments_created': self.segments_created,
+            'segments_reused': self.segments_reused,
+        }
+
+    def close(self):
+        """
+        Unlink all segments owned by this transport.
+        """
+        segments = list(self._in_use.values())
+        for free in self._idle.values():
+            segments.extend(free)
+
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+        self._idle.clear()
+        self._in_use.clear()
+        self._idle_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False